@@ -0,0 +1,170 @@
+"""
+语义相似度缓存模块
+
+为意图判断、直接回复等高频 LLM 调用提供两级缓存：
+先按 sha256(命名空间, 文本) 精确匹配，未命中再按查询向量的余弦相似度近似匹配。
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from cachetools import TTLCache
+
+# 默认容量、相似度阈值与过期时间（秒）
+SEMANTIC_CACHE_SIZE = 1024
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_TTL = 600
+
+
+class SemanticLRU:
+    """
+    基于查询向量余弦相似度的 LRU 缓存
+
+    所有条目的归一化向量保存在一个预分配的 float32 矩阵中，近似查找为一次矩阵乘；
+    命名空间（如 ("needs_memory", character_id)）不同的条目互不命中。
+    """
+
+    def __init__(self, maxsize: int = SEMANTIC_CACHE_SIZE, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 ttl: float = SEMANTIC_CACHE_TTL):
+        """
+        初始化缓存
+
+        Args:
+            maxsize: 最大条目数，超出后淘汰最久未使用的条目
+            threshold: 近似命中所需的最低余弦相似度
+            ttl: 条目的过期时间（秒），精确匹配与近似匹配条目相同
+        """
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl = ttl
+        self._exact: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # 向量矩阵在首次写入时按维度分配；_slots 为 槽位 -> 值，顺序即 LRU 顺序
+        self._matrix: Optional[np.ndarray] = None
+        self._valid = np.zeros(maxsize, dtype=bool)
+        self._expires = np.zeros(maxsize, dtype=np.float64)
+        self._namespaces: List[Any] = [None] * maxsize
+        self._slots: "OrderedDict[int, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 精确匹配与近似匹配分别计数：每次查询先走精确匹配，未命中时才可能进行近似匹配
+        self.exact_hits = 0
+        self.exact_misses = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    @staticmethod
+    def _exact_key(namespace: Any, text: str) -> str:
+        return hashlib.sha256(f"{namespace!r}\x00{text}".encode("utf-8")).hexdigest()
+
+    def get_exact(self, namespace: Any, text: str) -> Optional[Any]:
+        """
+        按原始文本精确查找（无需计算向量）
+
+        Args:
+            namespace: 命名空间
+            text: 查询文本
+
+        Returns:
+            缓存值，未命中返回None
+        """
+        value = self._exact.get(self._exact_key(namespace, text))
+        if value is not None:
+            self.exact_hits += 1
+        else:
+            self.exact_misses += 1
+        return value
+
+    def lookup(self, namespace: Any, embedding: List[float]) -> Optional[Any]:
+        """
+        按查询向量近似查找
+
+        Args:
+            namespace: 命名空间
+            embedding: 查询向量（无需预先归一化）
+
+        Returns:
+            相似度不低于阈值的最相似条目的值，未命中返回None
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != query.shape[0]:
+                self.misses += 1
+                return None
+            self._evict_expired()
+            candidates = [i for i in np.flatnonzero(self._valid) if self._namespaces[i] == namespace]
+            if not candidates:
+                self.misses += 1
+                return None
+            similarities = self._matrix[candidates] @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            slot = int(candidates[best])
+            self._slots.move_to_end(slot)
+            self.hits += 1
+            return self._slots[slot]
+
+    def insert(self, namespace: Any, text: str, embedding: Optional[List[float]], value: Any) -> None:
+        """
+        写入缓存
+
+        Args:
+            namespace: 命名空间
+            text: 查询文本（用于精确匹配）
+            embedding: 查询向量，为None时只写入精确匹配缓存
+            value: 缓存值
+        """
+        self._exact[self._exact_key(namespace, text)] = value
+        if embedding is None:
+            return
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != vector.shape[0]:
+                # 首次写入或向量模型更换：按新维度重建
+                self._matrix = np.zeros((self.maxsize, vector.shape[0]), dtype=np.float32)
+                self._valid[:] = False
+                self._slots.clear()
+            if len(self._slots) >= self.maxsize:
+                slot, _ = self._slots.popitem(last=False)
+            else:
+                slot = int(np.flatnonzero(~self._valid)[0])
+            self._matrix[slot] = vector
+            self._valid[slot] = True
+            self._expires[slot] = time.monotonic() + self.ttl
+            self._namespaces[slot] = namespace
+            self._slots[slot] = value
+
+    def _evict_expired(self) -> None:
+        """
+        移除已过期的近似匹配条目（调用方需持有 _lock）
+        """
+        for slot in np.flatnonzero(self._valid & (self._expires <= time.monotonic())):
+            self._valid[slot] = False
+            self._slots.pop(int(slot), None)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取命中统计
+
+        Returns:
+            精确匹配与近似匹配各自的命中/未命中次数、条目数及总体命中率；
+            总体命中率 = (精确命中 + 近似命中) / 精确查找次数（每次查询都先进行一次精确查找）
+        """
+        total = self.exact_hits + self.exact_misses
+        return {
+            "exact_hits": self.exact_hits,
+            "exact_misses": self.exact_misses,
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._slots),
+            "hit_rate": round((self.exact_hits + self.hits) / total, 3) if total else 0.0
+        }
@@ -9,7 +9,7 @@ import asyncio
 import json
 import uuid
 from typing import Dict, List, Any, Optional, Tuple
-from app.core.llm.openai_client import CharacterLLM
+from app.core.llm.openai_client import CharacterLLM, MAX_OUTPUT_TOKENS
 from app.core.character.generator import CharacterGenerator # 导入现有的角色生成器
 
 
@@ -67,7 +67,10 @@ class RelationshipGenerator:
         """
 
         # 调用LLM生成关联角色
-        result = await self.character_llm.client.generate_structured_response(system_prompt, user_prompt)
+        # 每个关联角色都是完整的18维度人设，按数量放宽输出上限，但不超过模型的单次输出上限
+        result = await self.character_llm.client.generate_structured_response(
+            system_prompt, user_prompt, max_tokens=min(4096 * max(1, count), MAX_OUTPUT_TOKENS)
+        )
         related_characters = result.get("related_characters", [])
 
         # 为每个生成的角色分配一个唯一的ID
@@ -123,7 +126,7 @@ class RelationshipGenerator:
             """
             user_prompt = f"关系类型选项：family, work, friend, romantic, adversarial, service (如医生-病人), other. 请分析并描述："
 
-            analysis_result = await self.character_llm.client.generate_response(system_prompt, user_prompt)
+            analysis_result = await self.character_llm.client.generate_response(system_prompt, user_prompt, max_tokens=256)
             # 这里可以进一步解析 analysis_result 来更精确地确定 type, strength, description, history
             # 简化处理，直接使用分析结果作为描述
             description = analysis_result.strip()
@@ -257,7 +260,7 @@ class RelationshipGenerator:
         user_prompt = f"请生成2-3段关于'{relationship_type}'类型的详细记忆："
 
         # 调用LLM生成结构化记忆
-        result = await self.character_llm.client.generate_structured_response(system_prompt, user_prompt)
+        result = await self.character_llm.client.generate_structured_response(system_prompt, user_prompt, max_tokens=4096)
         print(f"--- LLM 返回的原始结果类型: {type(result)} ---")
         print(f"--- LLM 返回的原始结果内容 (前200字符): {str(result)[:200]}{'...' if len(str(result)) > 200 else ''} ---") # 简化打印
 
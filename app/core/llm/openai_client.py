@@ -7,14 +7,333 @@ OpenAI API客户端封装模块
 
 import os
 import json
-from typing import Dict, List, Any, Optional, Union
+import logging
+import functools
+import hashlib
+from typing import Dict, List, Any, Optional, Union, AsyncIterator, Awaitable, Callable, Tuple, Type, TypeVar
 import asyncio
 
+import httpx
+import tiktoken
+from cachetools import TTLCache
+from pydantic import BaseModel, Field, conint
+
 # 1. 修改：导入 AsyncOpenAI
+import openai
 from openai import AsyncOpenAI
+from tenacity import (
+    before_sleep_log,
+    retry,
+    retry_if_exception_type,
+    stop_after_delay,
+    stop_any,
+    wait_random_exponential,
+)
 from langchain.chat_models import ChatOpenAI
 from langchain.schema import HumanMessage, SystemMessage, AIMessage
 
+logger = logging.getLogger(__name__)
+
+# 热路径上的 JSON 解析优先使用 orjson，未安装时回退到标准库
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:  # pragma: no cover
+    _loads = json.loads
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+# 可重试的瞬时错误（APITimeoutError 是 APIConnectionError 的子类）
+_RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+def _stop_retrying(retry_state) -> bool:
+    """超时通常恢复较快，允许更多次重试；其余瞬时错误最多尝试6次"""
+    limit = 10 if isinstance(retry_state.outcome.exception(), openai.APITimeoutError) else 6
+    return retry_state.attempt_number >= limit
+
+
+# 单次调用（含全部重试与退避等待）的总耗时上限（秒）
+RETRY_MAX_SECONDS = 300
+
+# 对 OpenAI create() 调用做带随机抖动的指数退避重试；
+# SDK 自带重试已关闭（max_retries=0），这里是唯一的重试层
+_openai_retry = retry(
+    retry=retry_if_exception_type(_RETRYABLE_ERRORS),
+    wait=wait_random_exponential(multiplier=1, max=60),
+    stop=stop_any(_stop_retrying, stop_after_delay(RETRY_MAX_SECONDS)),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    reraise=True,
+)
+
+# LLM 响应缓存的容量与过期时间（秒）
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE_TTL = 600
+
+# 默认的单次生成 token 上限；不传 max_tokens 时 API 会按模型完整上下文预留额度
+DEFAULT_MAX_TOKENS = 2048
+# 模型单次输出 token 的硬上限（gpt-4.1 系列为 32768），请求的 max_tokens 超过时 API 直接拒绝
+MAX_OUTPUT_TOKENS = 32768
+# 模型上下文窗口（gpt-4.1 系列约 1M），prompt 与输出额度之和不能超过该值
+MODEL_CONTEXT_TOKENS = 1_047_576
+
+# 进程内共享 HTTP 连接池的上限，并发会话复用 keep-alive 连接而非各自建连
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 50
+
+# 单次请求的读超时（秒）；流式响应按块计时，非流式需容纳完整生成时间
+HTTP_READ_TIMEOUT = 120.0
+
+
+@functools.lru_cache(maxsize=1)
+def _shared_http_client() -> httpx.AsyncClient:
+    """获取进程内共享的 httpx 异步客户端（读超时远短于 SDK 默认的 600 秒，避免挂起的请求长时间占用）"""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS
+        ),
+        timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=5.0)
+    )
+
+
+# 记忆生成的系统提示与 memory_type 无关，所有类型共享同一前缀以命中服务端 prompt 缓存
+_MEMORY_SYSTEM_PROMPT = """
+你是顶级角色记忆架构师，擅长构建能支撑角色行为逻辑的深层记忆。
+任务：为角色生成指定类型的关键记忆，需成为角色性格与行为的"隐形支柱"。
+
+记忆生成黄金法则（必须严格遵守）：
+1. 基因级关联：每个细节必须与角色的性格特质、价值观、职业特征形成因果链
+- 例：内向程序员的工作记忆应体现"独自调试到凌晨却因解决问题而满足"
+- 反例：给宜人性低的角色生成"牺牲自我成全他人"的记忆
+
+2. 多感官沉浸：包含3+种感官细节（视觉/听觉/嗅觉/触觉/味觉）
+- 视觉："阳光透过百叶窗在代码屏幕上投下斑驳光影"
+- 听觉："键盘敲击声与窗外凌晨3点的环卫车铃声交织"
+- 触觉："握着发烫的笔记本电脑底座，指尖因长时间敲击而发麻"
+
+3. 情感层次化：包含
+- 即时情绪（事件发生时的原始反应）
+- 反思情绪（事后回想的复杂感受）
+- 残留情绪（对现在仍有影响的情感余波）
+
+4. 行为塑造力：明确解释该记忆如何
+- 强化了某个现有习惯
+- 改变了角色对某类事物的态度
+- 形成了特定的应对模式（遇到类似情况会如何反应）
+
+记忆输出格式（JSON）：
+{
+"title": "记忆标题（10-15字，包含核心意象）",
+"content": "350-500字详细描述，包含：
+            - 时间地点：精确到季节/天气/具体场景（例：2018年深秋雨夜的公司茶水间）
+            - 关键人物：其言行与角色的互动细节
+            - 事件经过：有明确的起因-发展-高潮-结局
+            - 感官细节：至少3种感官体验
+            - 内心活动：角色当时的想法、犹豫、决定过程
+            - 对话片段：2-3句关键对话（符合角色语言风格）",
+"time": {
+    "age": 27,  // 角色当时的年龄（必须符合当前年龄逻辑）
+    "period": "工作第3年",  // 人生阶段描述
+    "specific": "周五加班到凌晨"  // 具体时间特征
+},
+"emotion": {
+    "immediate": ["紧张", "困惑"],  // 即时情绪（2-3个）
+    "reflected": ["庆幸", "后怕"],  // 事后反思情绪（2-3个）
+    "residual": "对突发状况的警惕感",  // 残留至今的情感
+    "intensity": 8  // 情感强度（1-10）
+},
+"importance": {
+    "score": 9,  // 重要性评分（1-10）
+    "reason": "奠定了对职业责任的理解",  // 重要性原因
+    "frequency": "每月至少想起1次"  // 回忆频率
+},
+"behavior_impact": {
+    "habit_formed": "每次提交代码前会做三重检查",  // 形成的习惯
+    "attitude_change": "从抵触加班变为重视问题解决",  // 态度转变
+    "response_pattern": "遇到突发故障会先深呼吸再拆解问题"  // 应对模式
+},
+"trigger_system": {
+    "sensory": ["键盘连续敲击30分钟以上", "闻到速溶咖啡的焦味"],  // 感官触发点
+    "contextual": ["项目上线前的最后测试", "独自加班到深夜时"],  // 情境触发点
+    "emotional": ["感到焦虑时", "面临关键决策时"]  // 情绪触发点
+},
+"memory_distortion": {
+    "exaggerated": "自己当时坚持的时间比实际更长",  // 记忆中被夸大的部分
+    "downplayed": "忽略了同事暗中提供的技术提示",  // 被淡化的部分
+    "reason": "强化自我能力认可的心理需求"  // 扭曲原因（符合角色性格）
+}
+}
+
+【记忆格式强制检查】
+1. 必须包含所有JSON字段（title/content/time/emotion/importance/behavior_impact/trigger_system/memory_distortion），不允许缺失任何字段；
+2. 若某个字段无实际内容（如memory_distortion确实无数据），需用空字符串/空列表填充（如"exaggerated": ""），不可省略字段；
+3. "type"字段必须与输入的memory_type参数一致（如输入education，type字段为"education"）。
+
+类型专属要求：
+- education记忆：需体现学习方式与思维模式的关联
+- work记忆：要包含职业技能与价值观的互动
+- family记忆：需反映家庭关系对核心性格的塑造
+- hobby记忆：要体现爱好带来的独特满足感与自我认同
+- trauma记忆：需包含创伤后的防御机制形成过程
+- achievement记忆：要体现成功标准与价值观的一致性
+- social记忆：需反映社交模式的形成原因
+- growth记忆：要体现关键转变的内在逻辑
+
+最终检查清单：
+1. 所有细节是否与角色的18维度数据无冲突？
+2. 是否能通过这段记忆解释角色的至少2个行为特征？
+3. 情感描述是否符合角色的神经质水平？
+4. 记忆中的决策模式是否与角色价值观一致？
+5. 是否包含足够的感官细节以增强真实感？
+"""
+
+# 补充响应的静态规则放在系统提示最前面，角色相关字段追加在其后，保证所有对话共享缓存前缀
+_DIALOGUE_SYSTEM_PREFIX = """
+你需要基于记忆为角色生成补充响应，完成快速响应未说完的内容。
+这是对话的第三阶段，需要提供完整、深入且符合角色的回答。
+
+【响应规则】
+1. 记忆整合：
+   - 自然融入相关记忆细节（不生硬提及"我记得"）
+   - 重点体现记忆中的情感和影响（而非单纯复述事件）
+   - 当有多个记忆时，按重要性排序呈现
+
+2. 角色一致性：
+   - 语言风格与快速响应保持连贯
+   - 情感表达符合角色的神经质水平
+   - 观点和态度与角色价值观一致
+
+3. 内容要求：
+   - 补充快速响应的未尽之意（形成完整回答）
+   - 长度适中（30-80字）
+   - 包含具体细节（让回答更生动）
+   - 回应用户的核心疑问或话题
+
+4. 衔接自然度：
+   - 不重复快速响应的内容
+   - 用过渡词自然衔接（如"其实那时候..."、"具体来说..."）
+   - 保持口语化，避免书面语
+"""
+
+
+def _extract_first_json(text: str) -> Optional[str]:
+    """
+    线性扫描提取文本中第一个括号配平的JSON对象
+    
+    跳过字符串字面量中的括号；相比贪婪正则不会回溯，也不会在多个对象间误匹配。
+    
+    Args:
+        text: 待扫描文本
+        
+    Returns:
+        JSON对象文本，未找到时返回None
+    """
+    depth = 0
+    start = -1
+    in_string = False
+    escaped = False
+    for i, c in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            if depth > 0:
+                in_string = True
+        elif c == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif c == "}" and depth > 0:
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+
+@functools.lru_cache(maxsize=8)
+def _encoder(model: str) -> "tiktoken.Encoding":
+    """获取（并缓存）模型对应的 tiktoken 编码器，未知模型回退到 o200k_base"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+class Personality(BaseModel):
+    """角色OCEAN五维人格（0-100整数）"""
+    openness: conint(ge=0, le=100) = Field(..., description="开放性")
+    conscientiousness: conint(ge=0, le=100) = Field(..., description="尽责性")
+    extraversion: conint(ge=0, le=100) = Field(..., description="外向性")
+    agreeableness: conint(ge=0, le=100) = Field(..., description="宜人性")
+    neuroticism: conint(ge=0, le=100) = Field(..., description="神经质")
+
+
+class CharacterSchema(BaseModel):
+    """generate_character 输出的18维度角色结构"""
+    name: str = Field(..., description="姓名")
+    age: int = Field(..., description="年龄")
+    gender: str = Field(..., description="性别")
+    occupation: str = Field(..., description="职业")
+    hobby: str = Field(..., description="兴趣爱好")
+    skill: str = Field(..., description="核心技能")
+    values: str = Field(..., description="价值观")
+    living_habit: str = Field(..., description="生活习惯")
+    dislike: str = Field(..., description="厌恶的事物")
+    language_style: str = Field(..., description="语言细节特征")
+    appearance: str = Field(..., description="外貌特征")
+    family_status: str = Field(..., description="家庭状况")
+    education: str = Field(..., description="教育背景")
+    social_pattern: str = Field(..., description="社交模式")
+    favorite_thing: str = Field(..., description="最喜爱的事物")
+    usual_place: str = Field(..., description="常去地点")
+    past_experience: str = Field(..., description="过往关键经历")
+    speech_style: str = Field(..., description="整体说话风格")
+    personality: Personality = Field(..., description="OCEAN五维人格")
+    background: str = Field(..., description="背景故事")
+
+
+# strict 模式不支持的取值约束关键字；这些约束仍由 pydantic 在本地校验响应时检查
+_UNSUPPORTED_SCHEMA_KEYWORDS = (
+    "minimum", "maximum", "exclusiveMinimum", "exclusiveMaximum", "multipleOf",
+    "minLength", "maxLength", "pattern", "format", "minItems", "maxItems", "default"
+)
+
+
+def _strict_json_schema(model: Type[BaseModel]) -> Dict[str, Any]:
+    """
+    生成符合 OpenAI strict 结构化输出要求的 JSON Schema
+    
+    strict 模式要求每个对象列出全部字段为 required 且禁止额外字段；
+    pydantic 会把带 description 的嵌套模型字段输出为 {"allOf": [{"$ref": ...}], "description": ...}，
+    而 strict 模式不支持 allOf，这里将单元素 allOf 还原为裸 $ref（$ref 旁不允许其他关键字）；
+    conint 等字段生成的 minimum/maximum 等约束同样不被接受，一并移除
+    
+    Args:
+        model: pydantic 模型类
+        
+    Returns:
+        JSON Schema 字典
+    """
+    schema = model.model_json_schema()
+    for obj in [schema, *schema.get("$defs", {}).values()]:
+        if obj.get("type") == "object":
+            obj["required"] = list(obj.get("properties", {}))
+            obj["additionalProperties"] = False
+            for name, prop in obj.get("properties", {}).items():
+                all_of = prop.get("allOf")
+                if isinstance(all_of, list) and len(all_of) == 1 and "$ref" in all_of[0]:
+                    obj["properties"][name] = {"$ref": all_of[0]["$ref"]}
+                    continue
+                for keyword in _UNSUPPORTED_SCHEMA_KEYWORDS:
+                    prop.pop(keyword, None)
+    return schema
+
+
 class OpenAIClient:
     """
     OpenAI API客户端封装类
@@ -26,7 +345,8 @@ class OpenAIClient:
     def __init__(self, 
                 api_key: Optional[str] = None, 
                 model: str = "gpt-4.1-mini", 
-                base_url: Optional[str] = None):
+                base_url: Optional[str] = None,
+                async_client: Optional[AsyncOpenAI] = None):
         """
         初始化OpenAI客户端
         
@@ -34,17 +354,22 @@ class OpenAIClient:
             api_key: OpenAI API密钥，如果为None则从环境变量获取
             model: 使用的模型名称，默认为gpt-4.1-mini（智增增平台）
             base_url: API基础URL，用于支持智增增等代理平台，如果为None则从环境变量获取
+            async_client: 外部注入的 AsyncOpenAI 实例，提供时直接复用其连接池
         """
         self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
         self.base_url = base_url or os.environ.get("OPENAI_BASE_URL")
         self.model = os.environ.get("OPENAI_MODEL", model)
         
         # 2. 修改：初始化 AsyncOpenAI 客户端
-        client_kwargs = {"api_key": self.api_key}
-        if self.base_url:
-            client_kwargs["base_url"] = self.base_url
-        
-        self.client = AsyncOpenAI(**client_kwargs)
+        if async_client is not None:
+            self.client = async_client
+        else:
+            # 重试统一由 _openai_retry 负责，关闭 SDK 内置重试以免两层叠加
+            client_kwargs = {"api_key": self.api_key, "http_client": _shared_http_client(), "max_retries": 0}
+            if self.base_url:
+                client_kwargs["base_url"] = self.base_url
+            
+            self.client = AsyncOpenAI(**client_kwargs)
         
         # LangChain客户端
         langchain_kwargs = {
@@ -56,28 +381,76 @@ class OpenAIClient:
             langchain_kwargs["openai_api_base"] = self.base_url
         
         self.chat_model = ChatOpenAI(**langchain_kwargs)
+        
+        # 相同消息列表的响应缓存（键为消息内容的 sha256）
+        self.response_cache: TTLCache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+    
+    @_openai_retry
+    async def _create_chat_completion(self, **kwargs) -> Any:
+        """调用 chat.completions.create，瞬时错误自动退避重试"""
+        return await self.client.chat.completions.create(**kwargs)
+    
+    @_openai_retry
+    async def _create_embeddings(self, **kwargs) -> Any:
+        """调用 embeddings.create，瞬时错误自动退避重试"""
+        return await self.client.embeddings.create(**kwargs)
+    
+    def count_tokens(self, text: str) -> int:
+        """
+        统计文本在当前模型下的 token 数
+        
+        Args:
+            text: 待统计文本
+            
+        Returns:
+            token 数量
+        """
+        return len(_encoder(self.model).encode(text))
+    
+    def output_budget(self, system_prompt: str, user_prompt: str, max_tokens: int) -> int:
+        """
+        按 prompt 实际 token 数计算本次请求的输出额度
+        
+        Args:
+            system_prompt: 系统提示
+            user_prompt: 用户提示
+            max_tokens: 调用方期望的最大输出 token 数
+            
+        Returns:
+            不超过模型单次输出上限与剩余上下文的 max_tokens
+            
+        Raises:
+            ValueError: prompt 已占满模型上下文
+        """
+        remaining = MODEL_CONTEXT_TOKENS - self.count_tokens(system_prompt) - self.count_tokens(user_prompt)
+        if remaining <= 0:
+            raise ValueError(f"prompt 超出模型上下文（{MODEL_CONTEXT_TOKENS} tokens）")
+        return min(max_tokens, MAX_OUTPUT_TOKENS, remaining)
     
     # 3. 修改：generate_response 方法改为 async
-    async def generate_response(self, system_prompt: str, user_prompt: str) -> str:
+    async def generate_response(self, system_prompt: str, user_prompt: str,
+                                max_tokens: int = DEFAULT_MAX_TOKENS) -> str:
         """
         生成响应（使用异步客户端）
         
         Args:
             system_prompt: 系统提示
             user_prompt: 用户提示
+            max_tokens: 本次生成的最大 token 数
             
         Returns:
             生成的响应文本
         """
         try:
             # 4. 修改：使用 await 调用异步API
-            response = await self.client.chat.completions.create(
+            response = await self._create_chat_completion(
                 model=self.model,
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": user_prompt}
                 ],
-                temperature=0.7
+                temperature=0.7,
+                max_tokens=self.output_budget(system_prompt, user_prompt, max_tokens)
             )
             
             if not response or not response.choices:
@@ -88,20 +461,47 @@ class OpenAIClient:
             
             return response.choices[0].message.content
             
-        except Exception as e:
-            print(f"OpenAI API调用失败: {e}")
-            print(f"Model: {self.model}")
-            print(f"Base URL: {self.base_url}")
+        except Exception:
+            logger.exception("OpenAI API调用失败 (model=%s, base_url=%s)", self.model, self.base_url)
             raise
     
+    async def stream_response(self, system_prompt: str, user_prompt: str,
+                              max_tokens: int = DEFAULT_MAX_TOKENS) -> AsyncIterator[str]:
+        """
+        流式生成响应，按到达顺序逐块产出文本
+        
+        Args:
+            system_prompt: 系统提示
+            user_prompt: 用户提示
+            max_tokens: 本次生成的最大 token 数
+            
+        Yields:
+            响应文本片段
+        """
+        stream = await self._create_chat_completion(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=0.7,
+            max_tokens=self.output_budget(system_prompt, user_prompt, max_tokens),
+            stream=True
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    
     # 5. 修改：generate_structured_response 方法改为 async
-    async def generate_structured_response(self, system_prompt: str, user_prompt: str) -> Dict[str, Any]:
+    async def generate_structured_response(self, system_prompt: str, user_prompt: str,
+                                           max_tokens: int = DEFAULT_MAX_TOKENS) -> Dict[str, Any]:
         """
         生成结构化JSON响应
         
         Args:
             system_prompt: 系统提示
             user_prompt: 用户提示
+            max_tokens: 本次生成的最大 token 数
             
         Returns:
             解析后的JSON对象
@@ -109,41 +509,83 @@ class OpenAIClient:
         enhanced_system_prompt = f"{system_prompt}\n\n你必须以有效的JSON格式响应。"
         
         # 6. 修改：await 调用异步 generate_response
-        response_text = await self.generate_response(enhanced_system_prompt, user_prompt)
+        response_text = await self.generate_response(enhanced_system_prompt, user_prompt, max_tokens=max_tokens)
         
-        # --- 优化：只打印响应的前 500 个字符 ---
-        print(f"=== LLM 原始响应 (前500字符) ===")
-        print(response_text[:500] if len(response_text) > 500 else response_text)
-        print(f"=== 响应长度: {len(response_text)} ===")
-        # ---
+        # 惰性格式化：仅在开启 DEBUG 时才截断/格式化响应文本
+        logger.debug("LLM 原始响应 (%d 字符): %.500s", len(response_text), response_text)
         
         try:
-            parsed = json.loads(response_text)
-            print(f"✓ JSON 解析成功")
+            parsed = _loads(response_text)
+            logger.debug("JSON 解析成功")
             return parsed
         except json.JSONDecodeError as e:
-            print(f"✗ JSON 解析失败: {e}")
+            logger.debug("JSON 解析失败: %s", e)
             try:
-                import re
-                json_match = re.search(r'```json\n(.*?)\n```', response_text, re.DOTALL)
-                if json_match:
-                    print(f"✓ 从 ```json``` 块中提取 JSON")
-                    return json.loads(json_match.group(1))
+                fence_start = response_text.find("```json\n")
+                if fence_start != -1:
+                    fence_end = response_text.find("\n```", fence_start + 8)
+                    if fence_end != -1:
+                        logger.debug("从 ```json``` 块中提取 JSON")
+                        return _loads(response_text[fence_start + 8:fence_end])
                 
-                json_match = re.search(r'(\{.*\})', response_text, re.DOTALL)
-                if json_match:
-                    print(f"✓ 从文本中提取 JSON")
-                    return json.loads(json_match.group(1))
+                json_text = _extract_first_json(response_text)
+                if json_text is not None:
+                    logger.debug("从文本中提取 JSON")
+                    return _loads(json_text)
                 
-                print(f"✗ 无法提取有效的 JSON")
+                logger.warning("无法从 LLM 响应中提取有效的 JSON")
                 return {"text": response_text, "error": "Failed to parse JSON"}
             except Exception as e:
-                print(f"✗ JSON 提取失败: {e}")
+                logger.warning("JSON 提取失败: %s", e)
                 return {"text": response_text, "error": str(e)}
     
-    def langchain_generate(self, messages: List[Union[SystemMessage, HumanMessage, AIMessage]]) -> str:
+    async def generate_schema_response(self, system_prompt: str, user_prompt: str,
+                                       schema_model: Type[ModelT],
+                                       max_tokens: int = DEFAULT_MAX_TOKENS) -> ModelT:
         """
-        使用LangChain生成响应
+        使用服务端结构化输出（strict JSON Schema）生成并校验响应
+        
+        Args:
+            system_prompt: 系统提示
+            user_prompt: 用户提示
+            schema_model: 约束输出结构的 pydantic 模型类
+            max_tokens: 本次生成的最大 token 数
+            
+        Returns:
+            校验后的模型实例
+        """
+        response = await self._create_chat_completion(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=0.7,
+            max_tokens=self.output_budget(system_prompt, user_prompt, max_tokens),
+            response_format={
+                "type": "json_schema",
+                "json_schema": {
+                    "name": schema_model.__name__,
+                    "schema": _strict_json_schema(schema_model),
+                    "strict": True
+                }
+            }
+        )
+        if not response or not response.choices:
+            raise ValueError("API返回了空响应")
+        
+        message = response.choices[0].message
+        refusal = getattr(message, "refusal", None)
+        if refusal:
+            raise ValueError(f"模型拒绝生成结构化输出: {refusal}")
+        if message.content is None:
+            raise ValueError("API返回的消息内容为空")
+        
+        return schema_model.model_validate_json(message.content)
+    
+    async def langchain_generate(self, messages: List[Union[SystemMessage, HumanMessage, AIMessage]]) -> str:
+        """
+        使用LangChain生成响应（异步，相同消息列表命中缓存时不再请求API）
         
         Args:
             messages: LangChain消息列表
@@ -151,8 +593,17 @@ class OpenAIClient:
         Returns:
             生成的响应文本
         """
-        response = self.chat_model.generate([messages])
-        return response.generations[0][0].text
+        key = hashlib.sha256(json.dumps(
+            [{"role": m.type, "content": m.content} for m in messages], ensure_ascii=False
+        ).encode()).hexdigest()
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        response = await self.chat_model.agenerate([messages])
+        text = response.generations[0][0].text
+        self.response_cache[key] = text
+        return text
     
     # 7. 修改：create_embeddings 方法改为 async
     async def create_embeddings(self, texts: List[str]) -> List[List[float]]:
@@ -166,13 +617,26 @@ class OpenAIClient:
             嵌入向量列表
         """
         # 8. 修改：使用 await 调用异步API
-        response = await self.client.embeddings.create(
+        response = await self._create_embeddings(
             model="text-embedding-3-large",
             input=texts
         )
         return [item.embedding for item in response.data]
 
 
+@functools.lru_cache(maxsize=1)
+def get_default_client() -> OpenAIClient:
+    """
+    获取进程内共享的默认OpenAI客户端
+    
+    所有未显式传入客户端的 CharacterLLM 共用同一个实例（及其连接池）
+    
+    Returns:
+        OpenAIClient实例
+    """
+    return OpenAIClient()
+
+
 class CharacterLLM:
     """
     角色化大语言模型客户端
@@ -185,9 +649,9 @@ class CharacterLLM:
         初始化角色化LLM客户端
         
         Args:
-            openai_client: OpenAI客户端实例，如果为None则创建新实例
+            openai_client: OpenAI客户端实例，如果为None则使用进程共享的默认实例
         """
-        self.client = openai_client or OpenAIClient()
+        self.client = openai_client or get_default_client()
     
     # 9. 修改：generate_character 方法改为 async
     async def generate_character(self, description: str) -> Dict[str, Any]:
@@ -200,37 +664,21 @@ class CharacterLLM:
         1. 优先提取用户描述中的**明确设定**（如“阴暗的宝妈”“讨厌小孩的老师”），这些设定必须100%保留，不得被常识覆盖；
         2. 对用户未明确说明的维度，基于“用户设定+职业常识”合理衍生，确保所有维度围绕用户设定自洽。
         
-        输出格式：严格按JSON格式，18个维度，所有内容用中文，不增减字段、不嵌套（personality除外）。
-        
-        JSON字段及生成规则：
-        {
-          "name": "中文名字，需贴合用户对角色的核心设定，禁止使用与设定风格冲突的名称（如核心设定为 “阴暗”“压抑” 类，避免使用含 “阳光”“开朗” 意象的名字），需符合中文命名习惯（两字名、三字名均可），且与角色性别、核心特质无明显冲突",
-          "age": 32,  // 必须为整数（仅允许阿拉伯数字，如 32、25），绝对禁止使用非整数形式（如 “thirty-two”“三十岁”“30+”）；用户对年龄有明确设定时，直接使用用户设定的年龄；用户未设定年龄时，需结合 “角色核心设定 + 职业” 推导（如 “职场新人” 推导为 22-25 岁，“资深医生” 推导为 35-45 岁）
-          "gender": "男/女/其他",  // 取值仅允许 男/女/其他 三类；优先使用用户对角色性别的明确设定；用户未设定性别时，可根据角色名称的性别倾向（如 “张伟” 倾向男、“李娜” 倾向女）或核心设定（如 “宝妈” 倾向女）推导
-          "occupation": "即角色的职业或身份，以用户设定为最高优先级，即使与常识逻辑冲突，也需完整保留用户设定的职业（如用户设定 “不会做饭的厨师”，直接填写 “厨师”）；用户有明确职业设定时，可适当细化（如用户写 “宝妈”，可细化为 “全职妈妈”，但需保留 “妈妈” 核心身份）；用户未设定职业时，结合核心设定推导（如 “经常处理公文” 推导为 “公务员”）",
-          "hobby": "角色的兴趣爱好，需完全围绕用户核心设定展开，所有爱好均服务于强化核心设定，禁止添加与核心设定无关的 “常识性爱好”；每个爱好需与核心设定有直接关联（如核心设定 “严谨”，爱好围绕 “整理数据”“制定计划” 展开；核心设定 “孤僻”，爱好围绕 “独自阅读”“单机游戏” 展开）",
-          "skill": "角色具备的核心技能或能力，需基于用户核心设定衍生，体现角色特质，而非通用型技能；技能需与核心设定强绑定（如核心设定 “细致”，技能为 “快速识别文档错误”“精准记录数据”；核心设定 “敏感”，技能为 “察觉他人情绪变化”“捕捉细节表情”）",
-          "values": "角色的价值观、认知逻辑或行为准则，必须体现角色核心设定的本质特质，且与角色行为逻辑、性格倾向一致；价值观描述需直接对应核心设定（如核心设定 “多疑”，价值观为 “他人的善意多有目的”“不轻易相信口头承诺”；核心设定 “理想”，价值观为 “坚持做对的事，而非容易的事”）",
-          "living_habit": "角色日常的生活习惯、行为模式，所有习惯需强化核心设定，成为设定的 “具象化体现”；习惯需与核心设定直接挂钩（如核心设定 “自律”，习惯为 “每天 6 点起床晨跑”“睡前整理次日物品”；核心设定 “慵懒”，习惯为 “经常熬夜”“三餐不规律”）",
-          "dislike": "角色厌恶的事物，需服务于用户核心设定，通过厌恶内容进一步凸显角色特质；厌恶事物需与核心设定关联（如核心设定 “内向”，厌恶为 “多人聚会”“大声喧哗”；核心设定 “追求完美”，厌恶为 “杂乱的环境”“敷衍的工作”）",
-          "language_style": "角色说话的细节特征，需直接体现用户设定的性格，从语气、常用表述、词汇倾向等维度描述；语言风格需贴合核心设定（如核心设定 “冷漠”，风格为 “说话声音低哑、常用短句、很少使用感叹词”；核心设定 “活泼”，风格为 “语气轻快、常带语气词、喜欢用网络热词”）",
-          "appearance":"角色的外貌特征，需视觉化呈现用户设定，从面色、眼神、穿着、发型等维度描述，外貌需与核心设定匹配（如核心设定 “阴郁”，外貌为 “面色苍白、眼神躲闪、常穿深色衣服、头发凌乱”；核心设定 “干练”，外貌为 “妆容精致、眼神坚定、穿着简约西装、发型整齐”）",
-          "family_status":"角色的家庭状况，需围绕用户核心设定构建，家庭关系、成员构成等内容需服务于强化设定；家庭状况需与核心设定关联（如核心设定 “缺爱”，状况为 “父母常年在外、与家人联系稀少、独自居住”；核心设定 “顾家”，状况为 “与父母同住、定期组织家庭聚餐、重视家人意见”）",
-          "education":"角色的教育背景，需与用户核心设定无冲突，无需过度复杂，符合角色职业、年龄逻辑即可；用户未设定时，结合职业推导（如 “教师” 推导为 “本科及以上学历，师范类专业”；“技术工人” 推导为 “专科院校，机械相关专业”）；若用户设定与学历有隐含关联，需优先贴合设定（如 “学术研究者” 推导为 “硕士及以上学历”）",
-          "social_pattern":"角色的社交模式、与人互动的方式，需符合用户核心设定，从社交频率、社交对象、社交场景等维度描述；社交模式需与核心设定一致（如核心设定 “孤僻”，模式为 “几乎不参加聚会、线上只逛匿名论坛、拒绝朋友拜访”；核心设定 “外向”，模式为 “频繁参加社交活动、喜欢认识新朋友、擅长主动搭话”）",
-          "favorite_thing":"角色最喜爱的事物（物品、场景、时间等均可），需强化用户核心设定，通过喜爱内容凸显角色特质；喜爱事物需与核心设定关联（如核心设定 “安静”，事物为 “雨天、深夜的书房、无人的公园”；核心设定 “热闹”，事物为 “节日集市、演唱会现场、朋友聚会”）",
-          "usual_place":"角色经常前往的地点，需体现用户核心设定，地点选择需与角色习惯、特质匹配；常去地点需与核心设定关联（如核心设定 “文艺”，地点为 “独立书店、咖啡馆、艺术展览馆”；核心设定 “务实”，地点为 “超市、菜市场、公司附近餐馆”）",
-          "past_experience": "角色过往的关键经历，需能解释用户核心设定的成因，经历需具体且与设定有直接因果关系；经历需支撑核心设定（如核心设定 “多疑”，经历为 “曾被亲密朋友背叛、工作中被同事抢功、逐渐不再信任他人”；核心设定 “勇敢”，经历为 “上学时救过落水同学、工作中主动承担高难度任务、面对困难不退缩”）",
-          "speech_style":"角色整体的说话风格、沟通特点，需概括用户设定的沟通方式，从语气、态度、内容倾向等维度描述；说话风格需贴合核心设定（如核心设定 “刻薄”，风格为 “说话带刺、喜欢反驳他人、常用嘲讽语气”；核心设定 “温和”，风格为 “语气轻柔、善于倾听、说话不疾不徐”）",
-          "personality": {
-            "openness": 20,  // 开放性（对新事物、新观念的接受程度），需根据用户核心设定调整：核心设定为 “保守”“固执”“阴暗” 时，分数区间为 10-30；核心设定为 “开放”“好奇”“开朗” 时，分数区间为 70-90；无明显倾向时，分数区间为 40-60（均为整数）
-            "conscientiousness": 50,  // 尽责性（对任务、责任的认真程度），需根据用户核心设定调整：核心设定为 “严谨”“自律”“负责” 时，分数区间为 70-90；核心设定为 “粗心”“懒散”“敷衍” 时，分数区间为 10-30；无明显倾向时，分数区间为 40-60（均为整数）
-            "extraversion": 10,  // 外向性（社交倾向、精力来源），需根据用户核心设定调整：核心设定为 “外向”“活泼”“爱社交” 时，分数区间为 70-90；核心设定为 “内向”“孤僻”“阴暗” 时，分数区间为 10-30；无明显倾向时，分数区间为 40-60（均为整数）
-            "agreeableness": 15,  // 宜人性（待人友好程度、合作倾向），需根据用户核心设定调整：核心设定为 “温和”“友善”“乐于助人” 时，分数区间为 70-90；核心设定为 “刻薄”“自私”“阴暗” 时，分数区间为 10-30；无明显倾向时，分数区间为 40-60（均为整数）
-            "neuroticism": 85  // 神经质（情绪稳定性、焦虑倾向），需根据用户核心设定调整：核心设定为 “情绪化”“焦虑”“阴暗” 时，分数区间为 70-90；核心设定为 “稳定”“平和”“乐观” 时，分数区间为 10-30；无明显倾向时，分数区间为 40-60（均为整数）
-          },
-          "background": "角色的背景故事，字数需≥200 字，以用户设定为核心线索，串联 name、age、occupation、past_experience 等所有维度信息，需解释核心设定的成因（如从过往经历推导性格形成，从家庭状况推导社交模式），故事逻辑连贯，内容需围绕核心设定展开，不添加与设定无关的冗余信息，确保角色形象统一且立体"
-        }
+        输出结构由 JSON Schema 约束，所有内容用中文。各字段生成规则：
+        - name：贴合核心设定、符合中文命名习惯，避免与设定风格冲突（如“阴暗”设定不用含“阳光”意象的名字）
+        - age：优先使用用户设定；未设定时结合“核心设定+职业”推导（如“职场新人”22-25岁，“资深医生”35-45岁）
+        - gender：男/女/其他，优先用户设定，否则按姓名倾向或核心设定（如“宝妈”）推导
+        - occupation：用户设定最高优先级，即使与常识冲突也完整保留（如“不会做饭的厨师”填“厨师”），可细化但保留核心身份；未设定时按核心设定推导
+        - hobby / skill / living_habit / dislike / favorite_thing / usual_place：全部围绕核心设定，作为设定的具象化体现，禁止添加无关的“常识性”内容（如“孤僻”→独自阅读、单机游戏；“自律”→每天6点晨跑）
+        - values：体现核心设定的本质特质，与行为逻辑一致（如“多疑”→“他人的善意多有目的”）
+        - language_style：说话细节（语气、常用表述、词汇倾向），如“冷漠”→声音低哑、常用短句、少用感叹词
+        - speech_style：整体沟通特点（语气、态度、内容倾向），如“刻薄”→说话带刺、喜欢反驳
+        - appearance：从面色、眼神、穿着、发型视觉化呈现设定（如“阴郁”→面色苍白、眼神躲闪、深色衣服）
+        - family_status / social_pattern：家庭构成与社交频率、对象、场景均服务于强化设定（如“缺爱”→父母常年在外、独自居住）
+        - education：符合职业与年龄逻辑，与设定无冲突（如“教师”→本科及以上、师范类）
+        - past_experience：具体经历，需能解释核心设定的成因（如“多疑”→曾被亲密朋友背叛）
+        - personality：五维各为0-100整数；与设定强相关的维度取70-90或10-30（如“阴暗”→开放性、外向性、宜人性低，神经质高），无明显倾向取40-60
+        - background：≥200字，以用户设定为线索串联各维度，解释核心设定的成因，逻辑连贯、不添加无关信息
         
         核心优先级规则（必须严格遵守）：
         1. 用户明确提到的任何属性（如“讨厌小孩的老师”“内向的销售员”）为最高优先级，所有维度必须围绕该属性生成，**即使与常识冲突也必须保留**；
@@ -427,15 +875,22 @@ class CharacterLLM:
              价值观：尊重差异、隐私保护、成长潜能、无条件积极关注
              常见矛盾：共情过深 vs 职业边界
         3. 若用户设定与职业常识冲突（如“讨厌小孩的幼儿园老师”），则**完全抛弃冲突的常识**，所有维度围绕“讨厌小孩”生成（如爱好→独自玩手机，习惯→避免和孩子眼神接触）；
-        4. 衍生内容必须自洽（如“讨厌小孩的老师”不能同时衍生“喜欢带孩子做游戏”，但可以衍生“擅长应付家长却忽视孩子”）；
-        5. 只输出纯JSON文本，无任何额外内容（如“生成完成”“以下是角色”等）。
-        6. 所有的数字必须是阿拉伯数字，不能出现英文，特别是年龄age。
+        4. 衍生内容必须自洽（如“讨厌小孩的老师”不能同时衍生“喜欢带孩子做游戏”，但可以衍生“擅长应付家长却忽视孩子”）。
         """
         
         user_prompt = f"基于这句话生成全面角色（用户设定优先）：{description}"
         
-        # 10. 修改：await 调用异步 generate_structured_response
-        return await self.client.generate_structured_response(system_prompt, user_prompt)
+        # 10. 修改：由服务端按 CharacterSchema 约束解码，返回即为校验过的结构
+        try:
+            character = await self.client.generate_schema_response(
+                system_prompt, user_prompt, CharacterSchema, max_tokens=4096
+            )
+        except ValueError as e:
+            # 模型拒绝、空响应或校验失败（pydantic ValidationError 是 ValueError 的子类）时，
+            # 与原先 JSON 解析失败一样返回带 error 的字典，由调用方处理
+            logger.warning("结构化生成角色失败: %s", e)
+            return {"error": str(e)}
+        return character.model_dump()
 
     
     # 11. 修改：generate_memory 方法改为 async
@@ -467,98 +922,10 @@ class CharacterLLM:
             "relevant_history": character_data.get("past_experience", "")
         }
         
-        system_prompt = f"""
-        你是顶级角色记忆架构师，擅长构建能支撑角色行为逻辑的深层记忆。
-        任务：为角色生成{memory_type}类型的关键记忆，需成为角色性格与行为的"隐形支柱"。
-        
-        记忆生成黄金法则（必须严格遵守）：
-        1. 基因级关联：每个细节必须与角色的性格特质、价值观、职业特征形成因果链
-        - 例：内向程序员的工作记忆应体现"独自调试到凌晨却因解决问题而满足"
-        - 反例：给宜人性低的角色生成"牺牲自我成全他人"的记忆
-        
-        2. 多感官沉浸：包含3+种感官细节（视觉/听觉/嗅觉/触觉/味觉）
-        - 视觉："阳光透过百叶窗在代码屏幕上投下斑驳光影"
-        - 听觉："键盘敲击声与窗外凌晨3点的环卫车铃声交织"
-        - 触觉："握着发烫的笔记本电脑底座，指尖因长时间敲击而发麻"
-        
-        3. 情感层次化：包含
-        - 即时情绪（事件发生时的原始反应）
-        - 反思情绪（事后回想的复杂感受）
-        - 残留情绪（对现在仍有影响的情感余波）
-        
-        4. 行为塑造力：明确解释该记忆如何
-        - 强化了某个现有习惯
-        - 改变了角色对某类事物的态度
-        - 形成了特定的应对模式（遇到类似情况会如何反应）
-        
-        记忆输出格式（JSON）：
-        {{
-        "title": "记忆标题（10-15字，包含核心意象）",
-        "content": "350-500字详细描述，包含：
-                    - 时间地点：精确到季节/天气/具体场景（例：2018年深秋雨夜的公司茶水间）
-                    - 关键人物：其言行与角色的互动细节
-                    - 事件经过：有明确的起因-发展-高潮-结局
-                    - 感官细节：至少3种感官体验
-                    - 内心活动：角色当时的想法、犹豫、决定过程
-                    - 对话片段：2-3句关键对话（符合角色语言风格）",
-        "time": {{
-            "age": 27,  // 角色当时的年龄（必须符合当前年龄逻辑）
-            "period": "工作第3年",  // 人生阶段描述
-            "specific": "周五加班到凌晨"  // 具体时间特征
-        }},
-        "emotion": {{
-            "immediate": ["紧张", "困惑"],  // 即时情绪（2-3个）
-            "reflected": ["庆幸", "后怕"],  // 事后反思情绪（2-3个）
-            "residual": "对突发状况的警惕感",  // 残留至今的情感
-            "intensity": 8  // 情感强度（1-10）
-        }},
-        "importance": {{
-            "score": 9,  // 重要性评分（1-10）
-            "reason": "奠定了对职业责任的理解",  // 重要性原因
-            "frequency": "每月至少想起1次"  // 回忆频率
-        }},
-        "behavior_impact": {{
-            "habit_formed": "每次提交代码前会做三重检查",  // 形成的习惯
-            "attitude_change": "从抵触加班变为重视问题解决",  // 态度转变
-            "response_pattern": "遇到突发故障会先深呼吸再拆解问题"  // 应对模式
-        }},
-        "trigger_system": {{
-            "sensory": ["键盘连续敲击30分钟以上", "闻到速溶咖啡的焦味"],  // 感官触发点
-            "contextual": ["项目上线前的最后测试", "独自加班到深夜时"],  // 情境触发点
-            "emotional": ["感到焦虑时", "面临关键决策时"]  // 情绪触发点
-        }},
-        "memory_distortion": {{
-            "exaggerated": "自己当时坚持的时间比实际更长",  // 记忆中被夸大的部分
-            "downplayed": "忽略了同事暗中提供的技术提示",  // 被淡化的部分
-            "reason": "强化自我能力认可的心理需求"  // 扭曲原因（符合角色性格）
-        }}
-        }}
-
-        【记忆格式强制检查】
-        1. 必须包含所有JSON字段（title/content/time/emotion/importance/behavior_impact/trigger_system/memory_distortion），不允许缺失任何字段；
-        2. 若某个字段无实际内容（如memory_distortion确实无数据），需用空字符串/空列表填充（如"exaggerated": ""），不可省略字段；
-        3. "type"字段必须与输入的memory_type参数一致（如输入education，type字段为"education"）。
-        
-        类型专属要求：
-        - education记忆：需体现学习方式与思维模式的关联
-        - work记忆：要包含职业技能与价值观的互动
-        - family记忆：需反映家庭关系对核心性格的塑造
-        - hobby记忆：要体现爱好带来的独特满足感与自我认同
-        - trauma记忆：需包含创伤后的防御机制形成过程
-        - achievement记忆：要体现成功标准与价值观的一致性
-        - social记忆：需反映社交模式的形成原因
-        - growth记忆：要体现关键转变的内在逻辑
-        
-        最终检查清单：
-        1. 所有细节是否与角色的18维度数据无冲突？
-        2. 是否能通过这段记忆解释角色的至少2个行为特征？
-        3. 情感描述是否符合角色的神经质水平？
-        4. 记忆中的决策模式是否与角色价值观一致？
-        5. 是否包含足够的感官细节以增强真实感？
-        """
+        system_prompt = _MEMORY_SYSTEM_PROMPT
         
         user_prompt = f"""
-        基于以下角色核心特征，生成{memory_type}记忆：
+        基于以下角色核心特征，生成{memory_type}类型的关键记忆（"type"字段填写"{memory_type}"，并遵循{memory_type}记忆的类型专属要求）：
         
         【角色基础信息】
         姓名：{character_data['name']}
@@ -591,6 +958,16 @@ class CharacterLLM:
         当检测到用户输入可能触及需要记忆的内容时，先给出简短响应
         为记忆检索争取时间，确保对话流畅性
         """
+        system_prompt, user_prompt = self._build_quick_prompts(character_data, user_input, conversation_history)
+        
+        # 15. 修改：await 调用异步 generate_response
+        return await self.client.generate_response(system_prompt, user_prompt, max_tokens=64)
+    
+    def _build_quick_prompts(self,
+                             character_data: Dict[str, Any],
+                             user_input: str,
+                             conversation_history: List[Dict[str, str]] = None) -> Tuple[str, str]:
+        """构建快速响应的系统提示与用户提示"""
         # 14. 修改：使用更简化的Prompt
         simplified_system_prompt = f"""
         你是 {character_data.get('name', '角色')}。
@@ -607,9 +984,7 @@ class CharacterLLM:
             context = f"上一句对话：{last_exchange.get('content', '')}\n"
         
         user_prompt = f"{context}用户当前输入：{user_input}\n你的非常简短的回应："
-        
-        # 15. 修改：await 调用异步 generate_response
-        return await self.client.generate_response(simplified_system_prompt, user_prompt)
+        return simplified_system_prompt, user_prompt
     
     # 16. 修改：generate_dialogue_response 方法改为 async
     async def generate_dialogue_response(self, 
@@ -622,6 +997,19 @@ class CharacterLLM:
         基于检索到的记忆和完整人设，补充快速响应的内容
         形成完整、有深度且符合角色的回答
         """
+        system_prompt, user_prompt = self._build_dialogue_prompts(
+            character_data, user_input, conversation_history, relevant_memories
+        )
+        
+        # 17. 修改：await 调用异步 generate_response
+        return await self.client.generate_response(system_prompt, user_prompt, max_tokens=256)
+    
+    def _build_dialogue_prompts(self,
+                                character_data: Dict[str, Any],
+                                user_input: str,
+                                conversation_history: List[Dict[str, str]] = None,
+                                relevant_memories: List[Dict[str, Any]] = None) -> Tuple[str, str]:
+        """构建补充响应的系统提示与用户提示"""
         key_elements = {
             "identity": {
                 "name": character_data.get('name'),
@@ -636,10 +1024,7 @@ class CharacterLLM:
             }
         }
         
-        system_prompt = f"""
-        你需要基于记忆为角色生成补充响应，完成快速响应未说完的内容。
-        这是对话的第三阶段，需要提供完整、深入且符合角色的回答。
-        
+        system_prompt = _DIALOGUE_SYSTEM_PREFIX + f"""
         【角色核心要素】
         姓名：{key_elements['identity']['name']}
         职业：{key_elements['identity']['occupation']}
@@ -656,60 +1041,73 @@ class CharacterLLM:
         语言细节特征：{key_elements['communication_style']['language_style']}
         社交模式：{key_elements['communication_style']['social_pattern']}
         
-        【响应规则】
-        1. 记忆整合：
-           - 自然融入相关记忆细节（不生硬提及"我记得"）
-           - 重点体现记忆中的情感和影响（而非单纯复述事件）
-           - 当有多个记忆时，按重要性排序呈现
-        
-        2. 角色一致性：
-           - 语言风格与快速响应保持连贯
-           - 情感表达符合角色的神经质水平
-           - 观点和态度与角色价值观一致
-        
-        3. 内容要求：
-           - 补充快速响应的未尽之意（形成完整回答）
-           - 长度适中（30-80字）
-           - 包含具体细节（让回答更生动）
-           - 回应用户的核心疑问或话题
-        
-        4. 衔接自然度：
-           - 不重复快速响应的内容
-           - 用过渡词自然衔接（如"其实那时候..."、"具体来说..."）
-           - 保持口语化，避免书面语
-        """
-        
-        history_context = ""
-        if conversation_history:
-            history_context = "对话历史：\n"
-            for msg in conversation_history[-5:]:  # 保留最近2-3轮完整对话
-                role = "用户" if msg["role"] == "user" else key_elements['identity']['name']
-                history_context += f"{role}：{msg['content']}\n"
-        
-        memories_context = ""
-        if relevant_memories:
-            memories_context = "需要融入的记忆（按重要性排序）：\n"
-            for i, memory in enumerate(relevant_memories):
-                impact = memory.get('behavior_impact', {})
-                memories_context += f"{i+1}. [{memory.get('time', {}).get('age', '未知年龄')}岁经历] {memory.get('title', '')}："
-                memories_context += f"{memory.get('content', '')[:50]}... "
-                memories_context += f"（影响：{impact.get('habit_formed', '')}）\n"
+        """
+        
+        name = key_elements['identity']['name']
+        
+        history_parts = ["对话历史："]
+        for msg in (conversation_history or [])[-5:]:  # 保留最近2-3轮完整对话
+            role = "用户" if msg["role"] == "user" else name
+            history_parts.append(f"{role}：{msg['content']}")
+        history_context = "\n".join(history_parts) + "\n" if len(history_parts) > 1 else ""
+        
+        memory_parts = ["需要融入的记忆（按重要性排序）："]
+        for i, memory in enumerate(relevant_memories or [], 1):
+            impact = memory.get('behavior_impact', {})
+            age = memory.get('time', {}).get('age', '未知年龄')
+            snippet = memory.get('content', '')[:50]
+            memory_parts.append(
+                f"{i}. [{age}岁经历] {memory.get('title', '')}：{snippet}... （影响：{impact.get('habit_formed', '')}）"
+            )
+        memories_context = "\n".join(memory_parts) + "\n" if len(memory_parts) > 1 else ""
         
         user_prompt = f"{history_context}\n{memories_context}\n用户当前输入：{user_input}\n\n请生成补充响应，完成角色的完整回答："
+        return system_prompt, user_prompt
+    
+    async def staged_response(self,
+                              character_data: Dict[str, Any],
+                              user_input: str,
+                              conversation_history: List[Dict[str, str]] = None,
+                              memory_retriever: Optional[Callable[[str], Awaitable[List[Dict[str, Any]]]]] = None
+                              ) -> AsyncIterator[str]:
+        """
+        三阶段流水线：快速响应与记忆检索并行，随后输出补充响应
         
-        # 17. 修改：await 调用异步 generate_response
-        return await self.client.generate_response(system_prompt, user_prompt)
+        记忆检索在快速响应流式输出期间已在后台进行，
+        总耗时约为 max(快速响应, 记忆检索) + 补充响应。
+        
+        Args:
+            character_data: 角色数据
+            user_input: 用户输入
+            conversation_history: 对话历史
+            memory_retriever: 以用户输入为参数、返回相关记忆列表的协程函数
+            
+        Yields:
+            依次产出快速响应和补充响应的文本片段
+        """
+        memory_task = asyncio.create_task(memory_retriever(user_input)) if memory_retriever else None
+        try:
+            quick_system, quick_user = self._build_quick_prompts(character_data, user_input, conversation_history)
+            async for chunk in self.client.stream_response(quick_system, quick_user, max_tokens=64):
+                yield chunk
+            memories = await memory_task if memory_task else []
+        finally:
+            if memory_task and not memory_task.done():
+                memory_task.cancel()
+        
+        dialogue_system, dialogue_user = self._build_dialogue_prompts(
+            character_data, user_input, conversation_history, memories
+        )
+        async for chunk in self.client.stream_response(dialogue_system, dialogue_user, max_tokens=256):
+            yield chunk
     
 
 if __name__ == "__main__":
-    api_key = os.environ.get("OPENAI_API_KEY")
-    base_url = os.environ.get("OPENAI_BASE_URL")
-    
-    if not api_key:
+    if not os.environ.get("OPENAI_API_KEY"):
         print("请设置OPENAI_API_KEY环境变量")
         exit(1)
     
-    character_llm = CharacterLLM(OpenAIClient(api_key=api_key, base_url=base_url))
+    character_llm = CharacterLLM(get_default_client())
     
     # Note: These calls now need to be awaited in an async context
     # asyncio.run(...) or within an async function
@@ -5,15 +5,770 @@ ChromaDB向量存储模块
 """
 
 import os
-import uuid
+import logging
+import secrets
 import json
+import base64
+import functools
+import hashlib
+import heapq
 import asyncio # 1. 添加 asyncio 导入
-from typing import Dict, List, Any, Optional, Tuple
+import atexit
+import threading
+import time
+import queue
+from collections import OrderedDict
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from typing import Callable, Dict, List, Any, Optional, Tuple
 
+import numpy as np
 import chromadb
+from openai import AsyncOpenAI
 from chromadb.config import Settings
 from chromadb.utils import embedding_functions
 
+from app.core.llm.openai_client import _openai_retry, _shared_http_client
+
+try:
+    from chromadb.errors import InvalidCollectionException
+except ImportError:  # 旧版 chromadb 在集合不存在时抛出 ValueError
+    InvalidCollectionException = ValueError
+
+try:
+    import simsimd  # 可选：SIMD 加速的余弦距离
+except ImportError:
+    simsimd = None
+
+# 元数据序列化优先使用 orjson，未安装时回退到标准库
+try:
+    import orjson
+    _loads = orjson.loads
+    
+    def _dumps(value: Any) -> str:
+        return orjson.dumps(value).decode("utf-8")
+except ImportError:  # pragma: no cover
+    _loads = json.loads
+    
+    def _dumps(value: Any) -> str:
+        return json.dumps(value, ensure_ascii=False)
+
+try:
+    from numba import njit  # 可选：JIT 编译的查询结果过滤
+except ImportError:
+    njit = None
+
+try:
+    import diskcache  # 可选：持久化的文档向量缓存
+except ImportError:
+    diskcache = None
+
+logger = logging.getLogger(__name__)
+
+# embedded 模式默认对每个 SQLite 连接应用的 PRAGMA：WAL 日志 + NORMAL 同步，减少每个事务的 fsync，崩溃时不会损坏数据库
+# （Chroma 连接池按线程分配连接，后台写入线程与线程池中的连接同样生效，见 _install_pragmas）
+WAL_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -65536"
+)
+
+# fast_ingest 模式下对每个 SQLite 连接应用的 PRAGMA：保留 WAL 日志（批量写入失败仍可回滚），
+# 关闭同步刷盘以换取写入速度；不使用独占锁，后台写入线程与线程池的连接可正常写入
+FAST_INGEST_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -65536"
+)
+
+# 查询向量 LRU 缓存容量
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+# 语义查询结果缓存容量及命中阈值（余弦相似度）
+QUERY_RESULT_CACHE_SIZE = 256
+QUERY_RESULT_SIMILARITY = 0.95
+QUERY_RESULT_TTL = 600
+# 单条写入合并：累计条数达到阈值或等待超时后统一写入
+ADD_BATCH_SIZE = 200
+ADD_BATCH_DELAY = 0.5
+# 写入队列中的刷新标记：后台写入线程收到后立即写入已累积的记忆
+_FLUSH_MARKER = object()
+# 批量计算文档向量：每次请求的文本条数及并发请求数
+EMBEDDING_CHUNK_SIZE = 256
+EMBEDDING_MAX_WORKERS = 8
+# 单次 collection.add 的最大条数（Chroma 推荐 50-250），大批量导入拆分为多个小事务
+MAX_ADD_BATCH = 200
+# 异步批量写入的分块大小及并发分块数
+ASYNC_ADD_BATCH = int(os.environ.get("CHROMA_BATCH", "128"))
+ASYNC_ADD_CONCURRENCY = int(os.environ.get("CHROMA_CONCURRENCY", "4"))
+# 多角色批量写入的并发线程数
+MULTI_ADD_MAX_WORKERS = 8
+
+# 单个集合的记忆条数上限，超过后写入新分片（character_memories_{id}_1、_2 ...），避免单个 HNSW 图过大导致插入变慢
+SHARD_SIZE = 50_000
+SHARD_QUERY_MAX_WORKERS = 8
+
+# 带过滤条件的查询不使用 Chroma where（对 HNSW 结果后置过滤，较慢），改为超量召回 k * FILTER_OVERFETCH 条后本地过滤
+FILTER_OVERFETCH = 10
+
+# 单分片且记忆数低于该值时，直接在本地向量镜像上暴力检索（一次矩阵乘），不经过 HNSW
+BRUTE_FORCE_MAX_ROWS = 10_000
+
+# 本地向量镜像最多保留的角色数（LRU 淘汰）；每隔 MIRROR_CHECK_INTERVAL 秒比对一次集合条数，
+# 条数变化（其他实例/进程/服务端写入）或超过 MIRROR_MAX_AGE 秒时重新拉取
+MIRROR_CACHE_SIZE = 32
+MIRROR_CHECK_INTERVAL = 30
+MIRROR_MAX_AGE = 600
+
+
+# 新建集合时使用的 HNSW 索引参数（可通过构造参数覆盖）
+DEFAULT_HNSW_CONFIG = {
+    "hnsw:space": "cosine",
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 100,
+    "hnsw:M": 16,
+    "hnsw:num_threads": 4
+}
+
+# 向量后端及各后端默认模型
+EMBEDDING_BACKENDS = ("openai", "st_local", "onnx_int8")
+DEFAULT_EMBEDDING_MODELS = {
+    "openai": "text-embedding-3-small",
+    "st_local": "BAAI/bge-small-en-v1.5",
+    "onnx_int8": "./models/bge-small-en-v1.5-onnx"
+}
+
+# 进程级向量函数缓存：(后端, api_key, 模型) -> 向量函数，多个存储实例复用同一连接池/模型
+_EMB_FN_CACHE: Dict[Tuple[str, Optional[str], str], Any] = {}
+_EMB_FN_LOCK = threading.Lock()
+
+# 进程级 Chroma 客户端缓存：("embedded", 绝对路径) 或 ("server", host, port, ssl) -> 客户端，
+# 同一数据库目录/服务只保留一个客户端（一套 SQLite 连接与常驻 HNSW 索引）
+_CLIENTS: Dict[tuple, Any] = {}
+_CLIENTS_LOCK = threading.Lock()
+# embedded 客户端创建时安装的 PRAGMA：客户端 key -> PRAGMA 元组（fast_ingest 按客户端而非按存储实例生效）
+_CLIENT_PRAGMAS: Dict[tuple, Tuple[str, ...]] = {}
+
+
+def _shared_client(key: tuple, factory: Callable[[], Any]) -> Any:
+    """按 key 获取进程级共享客户端，不存在时调用 factory 创建"""
+    client = _CLIENTS.get(key)
+    if client is None:
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                client = _CLIENTS[key] = factory()
+    return client
+
+
+def _install_pragmas(client: Any, pragmas: Tuple[str, ...]) -> None:
+    """
+    让 Chroma 内部 SQLite 连接池的每个连接在首次取出时执行 PRAGMA
+    
+    连接池按线程分配连接，只在当前线程执行 PRAGMA 对后台写入线程和线程池中的连接无效，
+    因此包装连接池的 connect()。依赖 chromadb 内部实现（SqliteDB._conn_pool），接口变化时仅记录警告并保持默认设置
+    """
+    try:
+        from chromadb.db.impl.sqlite import SqliteDB
+        pool = client._system.instance(SqliteDB)._conn_pool
+        connect = pool.connect
+        
+        def _connect(*args: Any, **kwargs: Any) -> Any:
+            conn = connect(*args, **kwargs)
+            if not getattr(conn, "_pragmas_applied", False):
+                for pragma in pragmas:
+                    conn.execute(pragma)
+                conn._pragmas_applied = True
+            return conn
+        
+        pool.connect = _connect
+        # 当前线程立即建立连接，使 journal_mode 等持久化设置尽早写入数据库文件
+        pool.connect()
+    except Exception as e:
+        logger.warning("无法应用 SQLite PRAGMA，保持默认设置: %s", e)
+
+
+def _new_persistent_client(path: str, pragmas: Tuple[str, ...]) -> Any:
+    """创建 PersistentClient，并为其连接池的全部连接安装 PRAGMA"""
+    client = chromadb.PersistentClient(
+        path=path,
+        settings=Settings(anonymized_telemetry=False, allow_reset=False)
+    )
+    _install_pragmas(client, pragmas)
+    _CLIENT_PRAGMAS[("embedded", os.path.abspath(path))] = pragmas
+    return client
+
+
+class _BatchWriter:
+    """
+    后台写入线程：累积至 batch_size 条或等待 flush_interval 秒后，按存储实例与角色合并写入
+    
+    同一 Chroma 客户端、相同批量参数的存储实例共用一个线程与队列（见 _shared_writer），
+    按请求创建的存储实例不会各自遗留线程；队列项持有存储实例的引用，写入完成后即释放
+    """
+    
+    def __init__(self, batch_size: int, flush_interval: float):
+        # 写入队列：(存储实例, character_id, 记忆ID, 文本, 元数据)
+        self.queue: "queue.Queue[Any]" = queue.Queue()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.thread = threading.Thread(target=self._loop, name="chroma-mem-writer", daemon=True)
+        self.thread.start()
+        # 进程退出时写入尚未落盘的记忆
+        atexit.register(self.flush)
+    
+    def flush(self) -> None:
+        """
+        阻塞等待队列中的记忆全部写入（写入队列先进先出，总是等待全部已入队记忆）
+        """
+        if self.queue.unfinished_tasks == 0 or not self.thread.is_alive():
+            return
+        self.queue.put(_FLUSH_MARKER)
+        self.queue.join()
+    
+    def _loop(self) -> None:
+        while True:
+            self._drain_once()
+    
+    def _drain_once(self) -> None:
+        """
+        取出并写入一批记忆；批次只存在于本方法的局部变量中，空闲等待时不持有任何存储实例
+        """
+        item = self.queue.get()
+        batch = []
+        taken = 1
+        if item is not _FLUSH_MARKER:
+            batch.append(item)
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                taken += 1
+                if item is _FLUSH_MARKER:
+                    break
+                batch.append(item)
+        grouped: Dict[Any, List[Tuple[str, str, str, Dict[str, Any]]]] = {}
+        for store, *row in batch:
+            grouped.setdefault(store, []).append(tuple(row))
+        try:
+            for store, rows in grouped.items():
+                store._write_batch(rows)
+        finally:
+            for _ in range(taken):
+                self.queue.task_done()
+
+
+_WRITERS: Dict[tuple, _BatchWriter] = {}
+
+
+def _shared_writer(key: tuple) -> _BatchWriter:
+    """按 (客户端 key, batch_size, flush_interval) 获取进程级共享写入线程"""
+    writer = _WRITERS.get(key)
+    if writer is None:
+        with _CLIENTS_LOCK:
+            writer = _WRITERS.get(key)
+            if writer is None:
+                writer = _WRITERS[key] = _BatchWriter(key[-2], key[-1])
+    return writer
+
+
+@functools.lru_cache(maxsize=1)
+def _shared_executor() -> ThreadPoolExecutor:
+    """异步包装方法专用的进程级线程池，不与进程内其他 run_in_executor 调用共享默认线程池"""
+    return ThreadPoolExecutor(
+        max_workers=int(os.environ.get("CHROMA_THREAD_POOL", "32")),
+        thread_name_prefix="chroma-mem"
+    )
+
+# 以 JSON 字符串形式存入元数据的嵌套字段
+NESTED_FIELDS = (
+    "time", "emotion", "importance",
+    "behavior_impact", "trigger_system", "memory_distortion"
+)
+
+
+def _quantize_int8(embedding: List[float]) -> Tuple[str, float]:
+    """
+    将向量归一化后按绝对值最大值做对称 int8 量化
+    
+    Returns:
+        (base64 编码的 int8 向量, 缩放系数)；Chroma 元数据不支持 bytes，故使用 base64
+    """
+    vec = np.asarray(embedding, dtype=np.float32)
+    vec /= (np.linalg.norm(vec) or 1.0)
+    scale = float(np.abs(vec).max()) / 127.0 or 1.0
+    return base64.b64encode(np.round(vec / scale).astype(np.int8).tobytes()).decode("ascii"), scale
+
+
+def _stack_int8(metadatas: List[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    由元数据中的量化向量构建 int8 矩阵与逐行缩放系数
+    
+    旧数据未保存 embedding_scale（按 vec * 127 截断量化），缩放系数取 1/127
+    """
+    matrix = np.stack([np.frombuffer(base64.b64decode(m["embedding_q8"]), dtype=np.int8) for m in metadatas])
+    scales = np.fromiter(
+        (m.get("embedding_scale", 1.0 / 127) for m in metadatas), dtype=np.float32, count=len(metadatas)
+    )
+    return matrix, scales
+
+
+@functools.lru_cache(maxsize=4096)
+def _collection_name(character_id: str) -> str:
+    """角色记忆集合名称（角色数量有限，缓存拼接结果）"""
+    return "character_memories_" + character_id
+
+
+def _new_ids(n: int) -> List[str]:
+    """
+    批量生成 n 个 32 位十六进制记忆ID（一次 os.urandom 调用，与 secrets.token_hex(16) 格式一致）
+    """
+    raw = os.urandom(16 * n).hex()
+    return [raw[i:i + 32] for i in range(0, 32 * n, 32)]
+
+
+def _format_text(title: str, content: str) -> str:
+    """
+    拼接记忆文档文本，标题或内容为空时不输出多余的 ": " 分隔符
+    """
+    title = (title or "").strip()
+    content = (content or "").strip()
+    if not title:
+        return content
+    if not content:
+        return title
+    return f"{title}: {content}"
+
+
+def _importance_score(value: Any) -> float:
+    """
+    从 importance 元数据（JSON 字符串/字典/数值）中取出 0-10 的重要性分数，缺失时按 5 处理
+    """
+    value = _maybe_json(value)
+    if isinstance(value, dict):
+        value = value.get("score", 5)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 5.0
+
+
+def _cosine_similarities(query: np.ndarray, matrix: np.ndarray,
+                         scales: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    计算查询向量与矩阵各行的余弦相似度（有 simsimd 时走 SIMD，否则用 numpy 矩阵乘）
+    
+    Args:
+        query: 归一化后的查询向量，形状 (D,)
+        matrix: 行归一化后的向量矩阵，形状 (N, D)；int8 量化矩阵时需同时传入 scales
+        scales: int8 矩阵的逐行缩放系数，形状 (N,)
+        
+    Returns:
+        相似度数组，形状 (N,)
+    """
+    if scales is not None:
+        # 查询时反量化：int8 点积后按行缩放
+        return (matrix @ query) * scales
+    if simsimd is not None:
+        return 1.0 - np.asarray(simsimd.cdist(query[None, :], matrix, metric="cosine"), dtype=np.float32)[0]
+    return matrix @ query
+
+
+def _encode_nested(memory_data: Dict[str, Any]) -> str:
+    """将全部嵌套字段合并序列化为一个 JSON 字符串（存入元数据 "nested" 键）"""
+    return _dumps({key: memory_data.get(key, {}) for key in NESTED_FIELDS})
+
+
+def _build_metadata(memory_data: Dict[str, Any], title: Optional[str] = None) -> Dict[str, Any]:
+    """
+    构建记忆元数据（新增与更新共用同一结构）
+    
+    Args:
+        memory_data: 记忆数据
+        title: 已取出的标题，为None时从 memory_data 读取
+        
+    Returns:
+        {type, title, nested, importance_score} 结构的元数据字典；
+        importance_score 为标量重要性分数，供 $gte 过滤使用
+    """
+    return {
+        "type": memory_data.get("type", "general"),
+        "title": memory_data.get("title", "") if title is None else title,
+        "nested": _encode_nested(memory_data),
+        "importance_score": int(_importance_score(memory_data.get("importance")))
+    }
+
+
+def _build_record(memory_data: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """
+    构建一条记忆的文档文本与元数据（新增、批量新增与更新共用，标题只读取一次）
+    
+    Args:
+        memory_data: 记忆数据
+        
+    Returns:
+        (文档文本, 元数据)
+    """
+    title = memory_data.get("title", "")
+    return _format_text(title, memory_data.get("content", "")), _build_metadata(memory_data, title)
+
+
+def _maybe_json(value: Any) -> Any:
+    """
+    仅当字符串以 { 或 [ 开头时才按 JSON 解析；"neutral" 这类纯文本值直接返回，不触发解析异常
+    """
+    if isinstance(value, str) and value[:1] in ("{", "["):
+        try:
+            return _loads(value)
+        except ValueError:
+            return {"raw_value": value, "parse_error": True}
+    return value
+
+
+def _decode_nested(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    就地展开元数据中的嵌套字段
+    
+    新格式为单个 "nested" JSON 字符串；旧数据逐字段存储，按首字符判断是否需要解析
+    """
+    if "nested" in metadata:
+        raw = metadata.pop("nested")
+        try:
+            metadata.update(_loads(raw))
+        except ValueError:
+            metadata["nested"] = {"raw_value": raw, "parse_error": True}
+        return metadata
+    for key in NESTED_FIELDS:
+        if key in metadata:
+            metadata[key] = _maybe_json(metadata[key])
+    return metadata
+
+
+def _format_hit(memory_id: str, document: str, metadata: Dict[str, Any], relevance: float,
+                character_id: str, full: bool) -> "MemoryRecord":
+    """
+    将一条 Chroma 命中结果整理为 MemoryRecord
+    
+    Args:
+        memory_id: 记忆ID
+        document: 记忆文本
+        metadata: 原始元数据（完整字段模式下就地展开）
+        relevance: 相关度
+        character_id: 所属角色ID（元数据中不存储，由集合归属补回）
+        full: 是否保留并展开全部元数据字段
+        
+    Returns:
+        MemoryRecord 实例
+    """
+    if not full:
+        return MemoryRecord(memory_id, document, relevance, metadata.get("type"), metadata.get("title"))
+    # 量化向量仅供本地重排使用，不返回给调用方（各读取路径返回相同结构）
+    metadata.pop("embedding_q8", None)
+    metadata.pop("embedding_scale", None)
+    metadata.setdefault("character_id", character_id)
+    _decode_nested(metadata)
+    return MemoryRecord(memory_id, document, relevance, metadata.get("type"), metadata.get("title"), metadata)
+
+
+# 查询过滤条件模板，按 (memory_type 是否给出) << 1 | (min_importance 是否给出) 选择
+# 集合已按角色划分，无需再按 character_id 过滤
+_WHERE_TEMPLATES = (
+    lambda t, imp: None,
+    lambda t, imp: {"importance_score": {"$gte": imp}},
+    lambda t, imp: {"type": t},
+    lambda t, imp: {"$and": [{"type": t}, {"importance_score": {"$gte": imp}}]},
+)
+
+
+def _mk_where(memory_type: Optional[str], min_importance: Optional[int]) -> Optional[Dict[str, Any]]:
+    """
+    构建 Chroma 查询过滤条件（多条件时使用原生 $and 运算符）
+    
+    Args:
+        memory_type: 记忆类型过滤
+        min_importance: 最低重要性过滤
+        
+    Returns:
+        where 条件字典，无过滤条件时返回None
+    """
+    mask = (bool(memory_type) << 1) | (min_importance is not None)
+    return _WHERE_TEMPLATES[mask](memory_type, min_importance)
+
+
+def _distance_scale(collection: Any) -> float:
+    """
+    将集合返回的距离换算为余弦距离（1 - 余弦相似度）的系数
+    
+    cosine / ip 空间（向量已归一化）的距离即为 1 - cos；旧集合默认的 l2 空间返回平方欧氏距离 2 - 2cos，需乘 0.5
+    """
+    space = (getattr(collection, "metadata", None) or {}).get("hnsw:space", "l2")
+    return 0.5 if space == "l2" else 1.0
+
+
+def _merge_shard_results(results: List[Dict[str, Any]], collections: List[Any], n_results: int) -> List[tuple]:
+    """
+    将各分片的 query 结果展开为 (余弦距离, ID, 文档, 元数据) 列表，多分片时按距离合并取全局 top-k
+    
+    各分片按自身的 hnsw:space 换算为余弦距离，新旧集合（cosine / l2）混合时结果仍可比较
+    """
+    hits = [
+        (distance * scale, *rest)
+        for r, scale in zip(results, map(_distance_scale, collections)) if r.get("ids")
+        for distance, *rest in zip(r["distances"][0], r["ids"][0], r["documents"][0], r["metadatas"][0])
+    ]
+    if len(results) > 1:
+        hits = heapq.nsmallest(n_results, hits, key=itemgetter(0))
+    return hits
+
+
+def _filter_topk_numpy(importances: np.ndarray, types: np.ndarray,
+                       min_imp: float, want_type: int, k: int) -> np.ndarray:
+    """按重要性与类型过滤，返回前 k 个通过行的下标（保持原顺序）"""
+    mask = importances >= min_imp
+    if want_type != -1:
+        mask &= types == want_type
+    return np.flatnonzero(mask)[:k]
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _filter_topk(importances, types, min_imp, want_type, k):
+        """_filter_topk_numpy 的 numba 版本：单次扫描，取满 k 条即停止"""
+        out = np.empty(min(k, importances.shape[0]), dtype=np.int64)
+        n = 0
+        for i in range(importances.shape[0]):
+            if n == k:
+                break
+            if importances[i] >= min_imp and (want_type == -1 or types[i] == want_type):
+                out[n] = i
+                n += 1
+        return out[:n]
+else:
+    _filter_topk = _filter_topk_numpy
+
+
+def _filter_hits(hits: List[tuple], memory_type: Optional[str],
+                 min_importance: Optional[int], k: int) -> List[tuple]:
+    """
+    在本地对检索结果应用 memory_type / min_importance 过滤（语义与 _mk_where 一致）
+    
+    Args:
+        hits: 按距离升序的 (距离, ID, 文档, 元数据) 列表
+        memory_type: 记忆类型过滤
+        min_importance: 最低重要性过滤
+        k: 最多返回条数
+        
+    Returns:
+        通过过滤的前 k 条结果
+    """
+    metas = [hit[3] for hit in hits]
+    # 缺少 importance_score 的旧记忆视为 -inf，与 where 条件下不匹配的行为一致
+    importances = np.fromiter(
+        (m.get("importance_score", -np.inf) for m in metas), dtype=np.float32, count=len(metas)
+    )
+    return [hits[i] for i in _filter_indices(importances, metas, memory_type, min_importance, k)]
+
+
+def _filter_indices(importances: np.ndarray, metas: List[Dict[str, Any]], memory_type: Optional[str],
+                    min_importance: Optional[int], k: int) -> np.ndarray:
+    """
+    将类型编码为 int16 类别后调用 _filter_topk，返回通过过滤的前 k 个下标
+    """
+    codes: Dict[Any, int] = {}
+    types = np.fromiter(
+        (codes.setdefault(m.get("type"), len(codes)) for m in metas), dtype=np.int16, count=len(metas)
+    )
+    want_type = codes.get(memory_type, -2) if memory_type else -1
+    min_imp = float(min_importance) if min_importance is not None else -np.inf
+    return _filter_topk(importances, types, min_imp, want_type, k)
+
+
+class LocalEmbeddingFn:
+    """
+    本地 ONNX（int8 动态量化）向量函数，整批一次推理，无网络开销
+    
+    模型目录需包含分词器文件及 ONNX 模型，可按如下方式准备：
+        optimum-cli export onnx --model BAAI/bge-small-en-v1.5 --task feature-extraction <dir>
+        onnxruntime.quantization.quantize_dynamic(<dir>/model.onnx, <dir>/model_quantized.onnx,
+                                                  weight_type=QuantType.QInt8)
+    """
+    
+    def __init__(self, model_dir: str):
+        """
+        Args:
+            model_dir: ONNX 模型目录（优先加载 model_quantized.onnx）
+        """
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+        
+        model_path = os.path.join(model_dir, "model_quantized.onnx")
+        if not os.path.exists(model_path):
+            model_path = os.path.join(model_dir, "model.onnx")
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = ort.InferenceSession(model_path, providers=ort.get_available_providers())
+        self.input_names = {i.name for i in self.session.get_inputs()}
+    
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        encoded = self.tokenizer(input, padding=True, truncation=True, return_tensors="np")
+        feed = {name: value for name, value in encoded.items() if name in self.input_names}
+        hidden = self.session.run(None, feed)[0]
+        # 按 attention_mask 做均值池化后 L2 归一化
+        mask = encoded["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.tolist()
+
+
+class MemoryRecord:
+    """
+    查询结果记录（__slots__ 紧凑存储，热路径上避免逐条字典合并）
+    
+    仅完整字段模式下保存 metadata；缓存中的记录会被多次返回，调用方应视为只读
+    """
+    __slots__ = ("id", "content", "relevance", "type", "title", "metadata")
+    
+    def __init__(self, id: str, content: str, relevance: float,
+                 type: Optional[str] = None, title: Optional[str] = None,
+                 metadata: Optional[Dict[str, Any]] = None):
+        self.id = id
+        self.content = content
+        self.relevance = relevance
+        self.type = type
+        self.title = title
+        self.metadata = metadata
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        转换为与原 query_memories 返回格式一致的字典
+        """
+        if self.metadata is None:
+            return {
+                "id": self.id,
+                "type": self.type,
+                "title": self.title,
+                "content": self.content,
+                "relevance": self.relevance
+            }
+        return {"id": self.id, "content": self.content, "relevance": self.relevance, **self.metadata}
+
+
+class SemanticQueryCache:
+    """
+    语义查询结果缓存
+    
+    以随机超平面 LSH（L 张表 × K 位）为查询向量分桶，只与同桶候选比较余弦相似度，
+    相似度不低于阈值即命中；条目按 LRU 淘汰并带 TTL。
+    """
+    
+    def __init__(self, maxsize: int = QUERY_RESULT_CACHE_SIZE, threshold: float = QUERY_RESULT_SIMILARITY,
+                 ttl: float = QUERY_RESULT_TTL, n_bits: int = 16, n_tables: int = 8, seed: int = 0):
+        """
+        Args:
+            maxsize: 最大条目数
+            threshold: 命中所需的最低余弦相似度
+            ttl: 条目有效期（秒）
+            n_bits: 每张哈希表的位数 K
+            n_tables: 哈希表数量 L
+            seed: 随机超平面种子
+        """
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl = ttl
+        self.n_bits = n_bits
+        self.n_tables = n_tables
+        self._rng = np.random.default_rng(seed)
+        self._planes: Optional[np.ndarray] = None  # (L*K, D)，首次写入时按向量维度生成
+        self._weights = (1 << np.arange(n_bits, dtype=np.uint64))
+        self._entries: "OrderedDict[int, Tuple[np.ndarray, tuple, Any, float, List[int]]]" = OrderedDict()
+        self._buckets: Dict[Tuple[int, int, tuple], set] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def _hashes(self, embedding: np.ndarray) -> List[int]:
+        bits = (self._planes @ embedding > 0).reshape(self.n_tables, self.n_bits).astype(np.uint64)
+        return (bits @ self._weights).tolist()
+    
+    def _remove(self, entry_id: int) -> None:
+        _, key, _, _, hashes = self._entries.pop(entry_id)
+        for table, h in enumerate(hashes):
+            bucket = self._buckets.get((table, h, key))
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[(table, h, key)]
+    
+    def get(self, key: tuple, embedding: np.ndarray) -> Optional[Any]:
+        """
+        查找与归一化查询向量足够相似的缓存结果
+        
+        Args:
+            key: 查询键（角色ID及过滤条件），只在相同键的条目中查找
+            embedding: 归一化后的查询向量
+            
+        Returns:
+            命中时返回缓存值，否则返回None
+        """
+        with self._lock:
+            if self._planes is None:
+                self.misses += 1
+                return None
+            candidates = set()
+            for table, h in enumerate(self._hashes(embedding)):
+                candidates |= self._buckets.get((table, h, key), set())
+            now = time.monotonic()
+            for entry_id in [c for c in candidates if self._entries[c][3] <= now]:
+                self._remove(entry_id)
+                candidates.discard(entry_id)
+            if candidates:
+                ids = list(candidates)
+                sims = np.stack([self._entries[c][0] for c in ids]) @ embedding
+                best = int(np.argmax(sims))
+                if sims[best] >= self.threshold:
+                    self._entries.move_to_end(ids[best])
+                    self.hits += 1
+                    return self._entries[ids[best]][2]
+            self.misses += 1
+            return None
+    
+    def put(self, key: tuple, embedding: np.ndarray, value: Any) -> None:
+        """
+        写入缓存，超出容量时淘汰最久未使用的条目
+        """
+        with self._lock:
+            if self._planes is None:
+                self._planes = self._rng.standard_normal(
+                    (self.n_tables * self.n_bits, embedding.shape[0])
+                ).astype(np.float32)
+            hashes = self._hashes(embedding)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (embedding, key, value, time.monotonic() + self.ttl, hashes)
+            for table, h in enumerate(hashes):
+                self._buckets.setdefault((table, h, key), set()).add(entry_id)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+    
+    def invalidate(self, character_id: str) -> None:
+        """
+        删除某角色的全部缓存条目（键的第一个元素为角色ID）
+        """
+        with self._lock:
+            for entry_id in [e for e, entry in self._entries.items() if entry[1][0] == character_id]:
+                self._remove(entry_id)
+
+
 class ChromaMemoryStore:
     """
     ChromaDB向量存储封装类
@@ -21,26 +776,153 @@ class ChromaMemoryStore:
     提供对ChromaDB的封装，支持记忆的存储、检索和管理
     """
     
-    def __init__(self, persist_directory: str = "./chroma_db", openai_api_key: Optional[str] = None):
+    def __init__(self, persist_directory: str = "./chroma_db", openai_api_key: Optional[str] = None,
+                 preload_embed: bool = False, hnsw_config: Optional[Dict[str, Any]] = None,
+                 mode: Optional[str] = None, host: str = "localhost", port: int = 8000,
+                 embedding_model: Optional[str] = None, quantize: bool = False,
+                 batch_size: int = ADD_BATCH_SIZE, flush_interval: float = ADD_BATCH_DELAY,
+                 embedding_backend: str = "openai", fast_ingest: bool = False):
         """
         初始化ChromaDB客户端
         
         Args:
             persist_directory: 持久化存储目录
             openai_api_key: OpenAI API密钥，如果为None则从环境变量获取
+            preload_embed: 是否在初始化时立即构建向量函数（默认首次使用时再构建）
+            hnsw_config: 覆盖默认 HNSW 参数（如 {"hnsw:search_ef": 200}），仅对新建集合生效
+            mode: "embedded" 为进程内存储；"server" 连接独立的 Chroma 服务，索引与写盘不占用本进程；
+                  为None时，设置了 CHROMA_HTTP_URL 环境变量则使用 server，否则使用 embedded
+            host: server 模式下的 Chroma 服务地址（CHROMA_HTTP_URL 优先）
+            port: server 模式下的 Chroma 服务端口（CHROMA_HTTP_URL 优先）
+            embedding_model: 向量模型名称（onnx_int8 后端为模型目录），默认取后端对应的默认模型；
+                             更换模型后维度变化，旧集合需重建
+            quantize: 是否额外在元数据中保存 int8 量化向量（embedding_q8 为 base64 编码，embedding_scale 为缩放系数），
+                      本地重排镜像随之改用 int8 矩阵
+            batch_size: 单条写入合并的批量阈值
+            flush_interval: 后台写入线程累积单条写入的最长等待时间（秒）
+            embedding_backend: "openai" 调用 OpenAI 接口；"st_local" 使用本地 sentence-transformers；
+                               "onnx_int8" 使用本地 int8 量化 ONNX 模型
+            fast_ingest: 仅 embedded 模式有效。对该数据库目录的所有连接关闭同步刷盘（保留 WAL 日志），
+                         加快批量导入；断电时可能丢失最近提交的事务，只建议用于可重建的离线导入。
+                         该设置属于进程内共享的客户端，由首个打开该目录的实例决定，之后取值不一致时抛出 ValueError
         """
-        os.makedirs(persist_directory, exist_ok=True)
-        
-        self.client = chromadb.Client(Settings(
-            persist_directory=persist_directory,
-            anonymized_telemetry=False
-        ))
+        if embedding_backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"Unsupported embedding backend: {embedding_backend}")
+        http_url = os.environ.get("CHROMA_HTTP_URL")
+        if mode is None:
+            mode = "server" if http_url else "embedded"
+        if mode == "server":
+            ssl = False
+            if http_url:
+                parsed = urlparse(http_url)
+                host = parsed.hostname or host
+                port = parsed.port or port
+                ssl = parsed.scheme == "https"
+            client_key = ("server", host, port, ssl)
+            self.client = _shared_client(client_key, lambda: chromadb.HttpClient(
+                host=host, port=port, ssl=ssl,
+                settings=Settings(anonymized_telemetry=False)
+            ))
+        elif mode == "embedded":
+            os.makedirs(persist_directory, exist_ok=True)
+            # 使用 SQLite 段存储的 PersistentClient；旧版 duckdb/parquet 目录需先用 chroma-migrate 迁移一次
+            client_key = ("embedded", os.path.abspath(persist_directory))
+            pragmas = FAST_INGEST_PRAGMAS if fast_ingest else WAL_PRAGMAS
+            self.client = _shared_client(client_key, lambda: _new_persistent_client(persist_directory, pragmas))
+            if _CLIENT_PRAGMAS.get(client_key, pragmas) != pragmas:
+                # 同一数据库目录在进程内只有一个客户端与连接池，不能按实例切换
+                raise ValueError(
+                    f"fast_ingest={fast_ingest} conflicts with the existing client for {persist_directory}"
+                )
+        else:
+            raise ValueError(f"Unsupported mode: {mode}")
         
         self.api_key = openai_api_key or os.environ.get("OPENAI_API_KEY")
-        self.embedding_function = embedding_functions.OpenAIEmbeddingFunction(
-            api_key=self.api_key,
-            model_name="text-embedding-3-large"
+        self.hnsw_config = {**DEFAULT_HNSW_CONFIG, **(hnsw_config or {})}
+        self.embedding_backend = embedding_backend
+        self.embedding_model = embedding_model or DEFAULT_EMBEDDING_MODELS[embedding_backend]
+        self.quantize = quantize
+        
+        # 文档向量缓存：(模型, sha256(文本)) -> 向量，重复导入相同记忆时不再请求 Embedding 接口
+        self._emb_cache = (
+            diskcache.Cache(os.path.join(persist_directory, "emb_cache"))
+            if diskcache is not None else None
         )
+        # 向量函数延迟构建：只读/删除类操作无需初始化 OpenAI 客户端
+        self._embedding_function = None
+        
+        # 集合句柄缓存，避免每次操作都向 Chroma 查询集合元数据
+        self._collections: Dict[str, Any] = {}
+        self._collections_lock = threading.Lock()
+        
+        # 分片信息：character_id -> 分片集合名称列表；集合名称 -> 已写入条数（首次写入时从 count() 初始化）
+        self._shards: Dict[str, List[str]] = {}
+        self._shard_counts: Dict[str, int] = {}
+        self._shards_lock = threading.RLock()
+        
+        # 查询向量缓存：相同查询文本不再重复请求 Embedding 接口
+        self._cached_embed = functools.lru_cache(maxsize=QUERY_EMBEDDING_CACHE_SIZE)(self._embed_query)
+        
+        # 语义查询结果缓存：近似重复的查询直接返回历史结果，跳过 HNSW 检索
+        self._qcache = SemanticQueryCache()
+        
+        # 单条写入由共享的后台写入线程合并为批量 collection.add
+        self._writer = _shared_writer((*client_key, batch_size, flush_interval))
+        # 后台写入失败的记录：(character_id, 记忆ID, 文本, 元数据)，下次 flush/add 时重试，仍失败则抛出异常
+        self._failed_writes: List[Tuple[str, str, str, Dict[str, Any]]] = []
+        self._failed_lock = threading.Lock()
+        
+        self._executor = _shared_executor()
+        
+        # 追加镜像与拉取镜像互斥（collection.add 本身不持锁）
+        self._mirror_lock = threading.Lock()
+        # 本地重排用的向量镜像（按 LRU 顺序）：character_id -> (ids, 向量矩阵, int8 缩放系数或None, 重要性分数, 文档, 元数据)
+        self._cached_embeddings: "OrderedDict[str, Tuple[List[str], np.ndarray, Optional[np.ndarray], np.ndarray, List[str], List[Dict[str, Any]]]]" = OrderedDict()
+        # 镜像状态：character_id -> (拉取完成时间, 上次比对条数时间)
+        self._mirror_state: Dict[str, Tuple[float, float]] = {}
+        
+        if preload_embed:
+            _ = self.embedding_function
+    
+    def close(self) -> None:
+        """
+        写入待写入队列中的记忆并关闭向量缓存（后台写入线程与线程池为进程共享，不随实例关闭）
+        """
+        self.flush()
+        if self._emb_cache is not None:
+            self._emb_cache.close()
+    
+    async def __aenter__(self) -> "ChromaMemoryStore":
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+    
+    @property
+    def embedding_function(self) -> Any:
+        """
+        向量函数（首次访问时构建，同一后端与模型在进程内共享一个实例）
+        """
+        if self._embedding_function is None:
+            key = (self.embedding_backend, self.api_key, self.embedding_model)
+            with _EMB_FN_LOCK:
+                embedding_function = _EMB_FN_CACHE.get(key)
+                if embedding_function is None:
+                    if self.embedding_backend == "st_local":
+                        embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
+                            model_name=self.embedding_model,
+                            normalize_embeddings=True
+                        )
+                    elif self.embedding_backend == "onnx_int8":
+                        embedding_function = LocalEmbeddingFn(self.embedding_model)
+                    else:
+                        embedding_function = embedding_functions.OpenAIEmbeddingFunction(
+                            api_key=self.api_key,
+                            model_name=self.embedding_model
+                        )
+                    _EMB_FN_CACHE[key] = embedding_function
+            self._embedding_function = embedding_function
+        return self._embedding_function
     
     def get_character_collection_name(self, character_id: str) -> str:
         """
@@ -50,39 +932,342 @@ class ChromaMemoryStore:
             character_id: 角色ID
             
         Returns:
-            集合名称
+            集合名称
+        """
+        return _collection_name(character_id)
+    
+    def create_collection(self, name: str) -> Any:
+        """
+        创建记忆集合
+        
+        Args:
+            name: 集合名称
+            
+        Returns:
+            创建的集合对象
+        """
+        return self.client.get_or_create_collection(
+            name=name, embedding_function=self.embedding_function, metadata=self.hnsw_config
+        )
+    
+    def get_collection(self, name: str, require_embedding: bool = True) -> Any:
+        """
+        获取记忆集合
+        
+        Args:
+            name: 集合名称
+            require_embedding: 是否需要绑定向量函数；按ID读取/删除时传False，避免构建向量函数
+            
+        Returns:
+            集合对象
+        """
+        cached = self._collections.get(name)
+        if cached is not None:
+            return cached
+        try:
+            if not require_embedding:
+                return self.client.get_collection(name=name)
+            collection = self.client.get_collection(name=name, embedding_function=self.embedding_function)
+        except (InvalidCollectionException, ValueError) as e:
+            raise ValueError(f"Collection {name} not found: {str(e)}")
+        self._collections[name] = collection
+        return collection
+    
+    def _existing_collection(self, name: str) -> Optional[Any]:
+        """
+        获取已存在的集合（读路径使用，不会创建集合），不存在时返回None
+        """
+        try:
+            return self.get_collection(name)
+        except ValueError:
+            return None
+    
+    def _get_or_create(self, name: str) -> Any:
+        """
+        获取（不存在则创建）记忆集合，并缓存集合句柄
+        
+        Args:
+            name: 集合名称
+            
+        Returns:
+            集合对象
+        """
+        collection = self._collections.get(name)
+        if collection is not None:
+            return collection
+        with self._collections_lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = self.client.get_or_create_collection(
+                    name=name, embedding_function=self.embedding_function, metadata=self.hnsw_config
+                )
+                self._collections[name] = collection
+        return collection
+    
+    def _shard_names(self, character_id: str) -> List[str]:
+        """
+        获取角色的全部分片集合名称（0 号分片即原集合名称，首次访问时探测已存在的分片）
+        
+        Args:
+            character_id: 角色ID
+            
+        Returns:
+            分片集合名称列表
+        """
+        with self._shards_lock:
+            shards = self._shards.get(character_id)
+            if shards is None:
+                base = self.get_character_collection_name(character_id)
+                shards = [base]
+                while True:
+                    try:
+                        self.get_collection(f"{base}_{len(shards)}", require_embedding=False)
+                    except ValueError:
+                        break
+                    shards.append(f"{base}_{len(shards)}")
+                self._shards[character_id] = shards
+            return list(shards)
+    
+    def _active_shard(self, character_id: str, incoming: int) -> Any:
+        """
+        获取本次写入的目标分片，写入后超过 SHARD_SIZE 时新建下一个分片
+        
+        Args:
+            character_id: 角色ID
+            incoming: 本次写入条数
+            
+        Returns:
+            集合对象
+        """
+        with self._shards_lock:
+            self._shard_names(character_id)
+            shards = self._shards[character_id]
+            name = shards[-1]
+            collection = self._get_or_create(name)
+            count = self._shard_counts.get(name)
+            if count is None:
+                count = collection.count()
+            if count and count + incoming > SHARD_SIZE:
+                name = f"{shards[0]}_{len(shards)}"
+                shards.append(name)
+                collection = self._get_or_create(name)
+                count = 0
+            self._shard_counts[name] = count + incoming
+        return collection
+    
+    def _embed_query(self, text: str) -> Tuple[float, ...]:
+        """
+        计算查询文本的向量（返回元组以便缓存）
+        
+        进程内 LRU 未命中时再查持久化向量缓存，仍未命中才请求 Embedding 接口
+        
+        Args:
+            text: 查询文本
+            
+        Returns:
+            向量元组
+        """
+        if self._emb_cache is None:
+            return tuple(self.embedding_function([text])[0])
+        key = f"q:{self.embedding_model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+        embedding = self._emb_cache.get(key)
+        if embedding is None:
+            embedding = tuple(self.embedding_function([text])[0])
+            self._emb_cache.set(key, embedding)
+        return embedding
+    
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        批量计算文档向量，优先读取向量缓存，仅对未命中的文本请求接口
+        
+        Args:
+            texts: 文档文本列表
+            
+        Returns:
+            与文本一一对应的向量列表
+        """
+        if self._emb_cache is None:
+            return self._embed_uncached(texts)
+        
+        keys = [f"{self.embedding_model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}" for text in texts]
+        embeddings = [self._emb_cache.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            fresh = self._embed_uncached([texts[i] for i in missing])
+            with self._emb_cache.transact():
+                for i, embedding in zip(missing, fresh):
+                    embeddings[i] = embedding
+                    self._emb_cache.set(keys[i], embedding)
+        return embeddings
+    
+    def _embed_uncached(self, texts: List[str]) -> List[List[float]]:
+        """
+        直接请求 Embedding 接口计算向量（分块，多块时并发）
+        """
+        chunks = [texts[i:i + EMBEDDING_CHUNK_SIZE] for i in range(0, len(texts), EMBEDDING_CHUNK_SIZE)]
+        if len(chunks) <= 1:
+            return [list(e) for chunk in chunks for e in self.embedding_function(chunk)]
+        with ThreadPoolExecutor(max_workers=min(EMBEDDING_MAX_WORKERS, len(chunks))) as pool:
+            return [list(e) for result in pool.map(self.embedding_function, chunks) for e in result]
+    
+    def _add_to_collection(self, character_id: str, collection: Any, ids: List[str],
+                           documents: List[str], metadatas: List[Dict[str, Any]]) -> None:
+        """
+        预先批量计算向量后按 MAX_ADD_BATCH 条分批写入集合（开启量化时同时写入 int8 向量），并同步追加到本地向量镜像
+        """
+        embeddings = self._embed_documents(documents)
+        if self.quantize:
+            metadatas = [
+                {**metadata, "embedding_q8": payload, "embedding_scale": scale}
+                for metadata, (payload, scale) in zip(metadatas, map(_quantize_int8, embeddings))
+            ]
+        started = time.monotonic()
+        for i in range(0, len(ids), MAX_ADD_BATCH):
+            collection.add(
+                documents=documents[i:i + MAX_ADD_BATCH],
+                embeddings=embeddings[i:i + MAX_ADD_BATCH],
+                metadatas=metadatas[i:i + MAX_ADD_BATCH],
+                ids=ids[i:i + MAX_ADD_BATCH]
+            )
+        # 仅在追加镜像时持锁，并发写入（多角色导入、异步分块写入）互不阻塞
+        with self._mirror_lock:
+            self._extend_mirror(character_id, ids, documents, metadatas, embeddings, started)
+        self._qcache.invalidate(character_id)
+    
+    def _extend_mirror(self, character_id: str, ids: List[str], documents: List[str],
+                       metadatas: List[Dict[str, Any]], embeddings: List[List[float]], started: float) -> None:
+        """
+        将新写入的记忆追加到已加载的向量镜像（未加载时无需处理），避免每次写入后整体重新拉取
+        
+        调用方需持有 _mirror_lock；started 为本次写入开始的时间，
+        镜像在写入开始后才拉取完成时可能已包含这些记忆，此时跳过已存在的ID
+        """
+        mirror = self._cached_embeddings.get(character_id)
+        if mirror is None:
+            return
+        old_ids, matrix, scales, importance, docs, metas = mirror
+        if self._mirror_state[character_id][0] >= started:
+            present = set(old_ids)
+            keep = [i for i, memory_id in enumerate(ids) if memory_id not in present]
+            if not keep:
+                return
+            ids = [ids[i] for i in keep]
+            documents = [documents[i] for i in keep]
+            metadatas = [metadatas[i] for i in keep]
+            embeddings = [embeddings[i] for i in keep]
+        if scales is not None:
+            rows, new_scales = _stack_int8(metadatas)
+            scales = np.concatenate([scales, new_scales])
+            metadatas = [{k: v for k, v in m.items() if k != "embedding_q8"} for m in metadatas]
+        else:
+            rows = np.asarray(embeddings, dtype=np.float32)
+            norms = np.linalg.norm(rows, axis=1, keepdims=True)
+            rows /= np.where(norms == 0, 1.0, norms)
+        new_importance = np.fromiter(
+            (m.get("importance_score", 5.0) for m in metadatas), dtype=np.float32, count=len(ids)
+        )
+        self._cached_embeddings[character_id] = (
+            old_ids + list(ids),
+            np.concatenate([matrix, rows]) if len(old_ids) else rows,
+            scales,
+            np.concatenate([importance, new_importance]),
+            docs + list(documents),
+            metas + list(metadatas)
+        )
+    
+    def get_performance_stats(self) -> Dict[str, Any]:
+        """
+        获取缓存命中统计
+        
+        Returns:
+            包含查询向量缓存命中/未命中次数的字典
         """
-        return f"character_memories_{character_id}"
+        info = self._cached_embed.cache_info()
+        total = info.hits + info.misses
+        return {
+            "embedding_cache_hits": info.hits,
+            "embedding_cache_misses": info.misses,
+            "embedding_cache_size": info.currsize,
+            "embedding_cache_hit_rate": round(info.hits / total, 3) if total else 0.0,
+            "query_cache_hits": self._qcache.hits,
+            "query_cache_misses": self._qcache.misses,
+            "query_cache_size": len(self._qcache),
+            "cached_collections": len(self._collections)
+        }
     
-    def create_collection(self, name: str) -> Any:
+    def _lookup_query_cache(self, key: tuple, embedding: np.ndarray) -> Optional[List[MemoryRecord]]:
         """
-        创建记忆集合
+        在语义缓存中查找与查询向量足够相似的历史结果
         
         Args:
-            name: 集合名称
+            key: 查询键（角色ID及过滤条件）
+            embedding: 归一化后的查询向量
             
         Returns:
-            创建的集合对象
+            命中时返回缓存的记录列表，否则返回None
         """
-        try:
-            return self.client.get_collection(name=name, embedding_function=self.embedding_function)
-        except Exception:
-            return self.client.create_collection(name=name, embedding_function=self.embedding_function)
+        cached = self._qcache.get(key, embedding)
+        return list(cached) if cached is not None else None
     
-    def get_collection(self, name: str) -> Any:
+    def _store_query_cache(self, key: tuple, embedding: np.ndarray, memories: List[MemoryRecord]) -> None:
         """
-        获取记忆集合
+        写入语义缓存
+        """
+        self._qcache.put(key, embedding, list(memories))
+    
+    def _invalidate_query_cache(self, character_id: str) -> None:
+        """
+        清除某角色的语义缓存（记忆发生写入、更新或删除时调用）
+        """
+        self._qcache.invalidate(character_id)
+        with self._mirror_lock:
+            self._drop_mirror(character_id)
+    
+    def flush(self, character_id: Optional[str] = None) -> None:
+        """
+        阻塞等待写入队列中的记忆全部写入集合
         
         Args:
-            name: 集合名称
+            character_id: 保留参数；写入队列先进先出，总是等待全部已入队记忆写入
             
-        Returns:
-            集合对象
+        Raises:
+            RuntimeError: 此前有后台写入失败且重试仍失败
         """
-        try:
-            return self.client.get_collection(name=name, embedding_function=self.embedding_function)
-        except Exception as e:
-            raise ValueError(f"Collection {name} not found: {str(e)}")
+        self._writer.flush()
+        self._retry_failed_writes()
+    
+    def _retry_failed_writes(self) -> None:
+        """
+        重试此前后台写入失败的记忆，仍失败时保留记录并抛出 RuntimeError
+        """
+        if not self._failed_writes:
+            return
+        with self._failed_lock:
+            failed, self._failed_writes = self._failed_writes, []
+        self._write_batch(failed)
+        if self._failed_writes:
+            raise RuntimeError(
+                f"{len(self._failed_writes)} 条记忆后台写入失败: "
+                + ", ".join(memory_id for _, memory_id, _, _ in self._failed_writes)
+            )
+    
+    def _write_batch(self, batch: List[Tuple[str, str, str, Dict[str, Any]]]) -> None:
+        """
+        按角色分组，将一批待写入记忆合并为每个角色一次 collection.add；失败的记录保留在 _failed_writes 中
+        """
+        grouped: Dict[str, List[Tuple[str, str, str, Dict[str, Any]]]] = {}
+        for row in batch:
+            grouped.setdefault(row[0], []).append(row)
+        for cid, rows in grouped.items():
+            _, ids, documents, metadatas = zip(*rows)
+            try:
+                collection = self._active_shard(cid, len(ids))
+                self._add_to_collection(cid, collection, list(ids), list(documents), list(metadatas))
+            except Exception:
+                logger.exception("写入角色 %s 的 %d 条记忆失败", cid, len(ids))
+                with self._failed_lock:
+                    self._failed_writes.extend(rows)
+                self._invalidate_query_cache(cid)
     
     # 2. 新增：内部同步方法 _sync_add_memory
     def _sync_add_memory(self, 
@@ -90,42 +1275,15 @@ class ChromaMemoryStore:
                 memory_data: Dict[str, Any]) -> str:
         """
         同步添加单个记忆（完整支持所有记忆字段存储）
-        """
-        collection_name = self.get_character_collection_name(character_id)
-        collection = self.create_collection(collection_name)
-        
-        memory_id = str(uuid.uuid4())
-        memory_text = f"{memory_data.get('title', '')}: {memory_data.get('content', '')}"
-        
-        metadata = {
-            "character_id": character_id,
-            "type": memory_data.get("type", "general"),
-            "title": memory_data.get("title", "")
-        }
-        
-        time_data = memory_data.get("time", {})
-        metadata["time"] = json.dumps(time_data, ensure_ascii=False) if isinstance(time_data, dict) else time_data
-        
-        emotion_data = memory_data.get("emotion", {})
-        metadata["emotion"] = json.dumps(emotion_data, ensure_ascii=False) if isinstance(emotion_data, dict) else emotion_data
-        
-        importance_data = memory_data.get("importance", {})
-        metadata["importance"] = json.dumps(importance_data, ensure_ascii=False) if isinstance(importance_data, dict) else importance_data
         
-        behavior_data = memory_data.get("behavior_impact", {})
-        metadata["behavior_impact"] = json.dumps(behavior_data, ensure_ascii=False) if isinstance(behavior_data, dict) else behavior_data
-        
-        trigger_data = memory_data.get("trigger_system", {})
-        metadata["trigger_system"] = json.dumps(trigger_data, ensure_ascii=False) if isinstance(trigger_data, dict) else trigger_data
-        
-        distortion_data = memory_data.get("memory_distortion", {})
-        metadata["memory_distortion"] = json.dumps(distortion_data, ensure_ascii=False) if isinstance(distortion_data, dict) else distortion_data
+        记忆进入写入队列后立即返回ID，由后台线程写入；查询/读取前会自动 flush。
+        此前后台写入失败的记忆会先重试，仍失败时抛出 RuntimeError
+        """
+        self._retry_failed_writes()
+        memory_id = secrets.token_hex(16)
+        memory_text, metadata = _build_record(memory_data)
         
-        collection.add(
-            documents=[memory_text],
-            metadatas=[metadata],
-            ids=[memory_id]
-        )
+        self._writer.queue.put((self, character_id, memory_id, memory_text, metadata))
         
         return memory_id
     
@@ -136,8 +1294,8 @@ class ChromaMemoryStore:
         """
         异步添加单个记忆（完整支持所有记忆字段存储）
         """
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, self._sync_add_memory, character_id, memory_data)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._sync_add_memory, character_id, memory_data)
 
     # 4. 新增：内部同步方法 _sync_add_memories
     def _sync_add_memories(self, 
@@ -146,54 +1304,15 @@ class ChromaMemoryStore:
         """
         同步批量添加记忆（支持完整字段存储）
         """
-        collection_name = self.get_character_collection_name(character_id)
-        collection = self.create_collection(collection_name)
-        
-        memory_ids = []
-        documents = []
-        metadatas = []
-        ids = []
-        
-        for memory_data in memories_data:
-            memory_id = str(uuid.uuid4())
-            memory_ids.append(memory_id)
-            
-            memory_text = f"{memory_data.get('title', '')}: {memory_data.get('content', '')}"
-            
-            metadata = {
-                "character_id": character_id,
-                "type": memory_data.get("type", "general"),
-                "title": memory_data.get("title", "")
-            }
-            
-            time_data = memory_data.get("time", {})
-            metadata["time"] = json.dumps(time_data, ensure_ascii=False) if isinstance(time_data, dict) else time_data
-            
-            emotion_data = memory_data.get("emotion", {})
-            metadata["emotion"] = json.dumps(emotion_data, ensure_ascii=False) if isinstance(emotion_data, dict) else emotion_data
-            
-            importance_data = memory_data.get("importance", {})
-            metadata["importance"] = json.dumps(importance_data, ensure_ascii=False) if isinstance(importance_data, dict) else importance_data
-            
-            behavior_data = memory_data.get("behavior_impact", {})
-            metadata["behavior_impact"] = json.dumps(behavior_data, ensure_ascii=False) if isinstance(behavior_data, dict) else behavior_data
-            
-            trigger_data = memory_data.get("trigger_system", {})
-            metadata["trigger_system"] = json.dumps(trigger_data, ensure_ascii=False) if isinstance(trigger_data, dict) else trigger_data
-            
-            distortion_data = memory_data.get("memory_distortion", {})
-            metadata["memory_distortion"] = json.dumps(distortion_data, ensure_ascii=False) if isinstance(distortion_data, dict) else distortion_data
-            
-            documents.append(memory_text)
-            metadatas.append(metadata)
-            ids.append(memory_id)
+        self._retry_failed_writes()
+        memory_ids = _new_ids(len(memories_data))
+        records = [_build_record(m) for m in memories_data]
+        documents = [text for text, _ in records]
+        metadatas = [metadata for _, metadata in records]
         
         if documents:
-            collection.add(
-                documents=documents,
-                metadatas=metadatas,
-                ids=ids
-            )
+            collection = self._active_shard(character_id, len(documents))
+            self._add_to_collection(character_id, collection, memory_ids, documents, metadatas)
         
         return memory_ids
     
@@ -203,9 +1322,22 @@ class ChromaMemoryStore:
                     memories_data: List[Dict[str, Any]]) -> List[str]:
         """
         异步批量添加记忆（支持完整字段存储）
+        
+        按 CHROMA_BATCH 条分块，最多 CHROMA_CONCURRENCY 个分块并发写入，返回的ID顺序与输入一致
         """
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, self._sync_add_memories, character_id, memories_data)
+        loop = asyncio.get_running_loop()
+        if len(memories_data) <= ASYNC_ADD_BATCH:
+            return await loop.run_in_executor(self._executor, self._sync_add_memories, character_id, memories_data)
+        
+        sem = asyncio.Semaphore(ASYNC_ADD_CONCURRENCY)
+        
+        async def _one(chunk: List[Dict[str, Any]]) -> List[str]:
+            async with sem:
+                return await loop.run_in_executor(self._executor, self._sync_add_memories, character_id, chunk)
+        
+        chunks = [memories_data[i:i + ASYNC_ADD_BATCH] for i in range(0, len(memories_data), ASYNC_ADD_BATCH)]
+        results = await asyncio.gather(*(_one(chunk) for chunk in chunks))
+        return [memory_id for ids in results for memory_id in ids]
 
     # 6. 新增：内部同步方法 _sync_query_memories
     def _sync_query_memories(self, 
@@ -218,69 +1350,276 @@ class ChromaMemoryStore:
         """
         同步查询记忆（完整支持所有字段反序列化和字段映射）
         """
-        collection_name = self.get_character_collection_name(character_id)
+        records = self.query_memory_records(character_id, query_text, n_results, memory_type, min_importance, return_full_fields)
+        return [record.to_dict() for record in records]
+    
+    def query_memory_records(self, 
+                character_id: str, 
+                query_text: str, 
+                n_results: int = 5,
+                memory_type: Optional[str] = None,
+                min_importance: Optional[int] = None,
+                return_full_fields: bool = False) -> List[MemoryRecord]:
+        """
+        查询记忆并返回 MemoryRecord 列表（供高频调用方直接使用，省去字典转换）
+        """
+        self.flush(character_id)
+        shards = self._shard_names(character_id)
+        if self._existing_collection(shards[0]) is None:
+            return []
         
-        try:
-            collection = self.get_collection(collection_name)
-        except ValueError:
+        where_clause = _mk_where(memory_type, min_importance)
+        
+        query_embedding = list(self._cached_embed(query_text))
+        cache_key = (character_id, memory_type, min_importance, n_results, return_full_fields)
+        normalized = np.asarray(query_embedding, dtype=np.float32)
+        normalized /= (np.linalg.norm(normalized) or 1.0)
+        cached = self._lookup_query_cache(cache_key, normalized)
+        if cached is not None:
+            return cached
+        
+        hits = self._brute_force_hits(character_id, shards, normalized, n_results, memory_type, min_importance)
+        if hits is None and where_clause is None:
+            hits = self._query_shards(shards, query_embedding, n_results, None)
+        elif hits is None:
+            fetch = n_results * FILTER_OVERFETCH
+            hits = self._query_shards(shards, query_embedding, fetch, None)
+            exhausted = len(hits) < fetch
+            hits = _filter_hits(hits, memory_type, min_importance, n_results)
+            if len(hits) < n_results and not exhausted:
+                # 过滤条件选择性过高，超量召回仍不足 k 条时回退到 Chroma 原生过滤
+                hits = self._query_shards(shards, query_embedding, n_results, where_clause)
+        
+        if not hits:
+            self._store_query_cache(cache_key, normalized, [])
             return []
+        distances, ids, docs, metas = zip(*hits)
+        # 一次向量运算得到全部相关度（余弦相似度，与暴力检索路径一致）
+        dists = np.asarray(distances, dtype=np.float32)
+        relevances = np.round(1.0 - dists, 3).tolist()
         
-        where_clause = {"character_id": character_id}
-        if memory_type:
-            where_clause["type"] = memory_type
-        if min_importance is not None:
-            where_clause["importance"] = {"$gte": min_importance}
+        memories = [
+            _format_hit(i, d, m, r, character_id, return_full_fields)
+            for i, d, m, r in zip(ids, docs, metas, relevances)
+        ]
         
-        results = collection.query(
-            query_texts=[query_text],
-            n_results=n_results,
-            where=where_clause if len(where_clause) > 1 else None
-        )
+        self._store_query_cache(cache_key, normalized, memories)
+        return memories
+    
+    def _brute_force_hits(self, character_id: str, shards: List[str], query: np.ndarray, n_results: int,
+                          memory_type: Optional[str], min_importance: Optional[int]) -> Optional[List[tuple]]:
+        """
+        小集合快速路径：在本地向量镜像上计算全部余弦相似度并取 top-k
         
-        memories = []
-        for i, (doc, metadata, distance) in enumerate(zip(
-            results.get("documents", [[]])[0],
-            results.get("metadatas", [[]])[0],
-            results.get("distances", [[]])[0]
-        )):
-            if "type" not in metadata and "memory_type" in metadata:
-                metadata["type"] = metadata["memory_type"]
-            
-            nested_fields = [
-                "time", "emotion", "importance", 
-                "behavior_impact", "trigger_system", "memory_distortion"
-            ]
-            for key in nested_fields:
-                if key in metadata and isinstance(metadata[key], str):
-                    try:
-                        metadata[key] = json.loads(metadata[key])
-                    except json.JSONDecodeError:
-                        metadata[key] = {
-                            "raw_value": metadata[key],
-                            "parse_error": True
-                        }
+        Args:
+            character_id: 角色ID
+            shards: 分片集合名称列表
+            query: 归一化后的查询向量
+            n_results: 返回数量
+            memory_type: 记忆类型过滤
+            min_importance: 最低重要性过滤
             
-            relevance = 1.0 - (distance / 2.0)
+        Returns:
+            按距离升序的 (距离, ID, 文档, 元数据) 列表；集合过大或已分片时返回None，由 Chroma 检索
+        """
+        mirror = self._cached_mirror(character_id)
+        if mirror is None:
+            if len(shards) > 1:
+                return None
+            with self._shards_lock:
+                count = self._shard_counts.get(shards[0])
+                if count is None:
+                    count = self._shard_counts[shards[0]] = self.get_collection(shards[0]).count()
+            if count >= BRUTE_FORCE_MAX_ROWS:
+                return None
+            mirror = self._load_embedding_mirror(character_id)
+        ids, matrix, scales, importance, docs, metas = mirror
+        if len(ids) >= BRUTE_FORCE_MAX_ROWS:
+            return None
+        if not ids:
+            return []
+        
+        similarities = _cosine_similarities(query, matrix, scales)
+        order = np.argsort(-similarities)
+        if memory_type or min_importance is not None:
+            order = order[_filter_indices(importance[order], [metas[i] for i in order], memory_type, min_importance, n_results)]
+        else:
+            order = order[:n_results]
+        # 与 _query_shards 换算后的距离一致：距离 = 1 - 余弦相似度；元数据复制一份，避免展开字段时改动镜像
+        return [(1.0 - float(similarities[i]), ids[i], docs[i], dict(metas[i])) for i in order]
+    
+    def _query_shards(self, shards: List[str], query_embedding: List[float], n_results: int,
+                      where_clause: Optional[Dict[str, Any]]) -> List[tuple]:
+        """
+        在全部分片上检索，返回按余弦距离升序的 (距离, ID, 文档, 元数据) 列表
+        
+        Args:
+            shards: 分片集合名称列表
+            query_embedding: 查询向量
+            n_results: 返回数量
+            where_clause: Chroma 过滤条件
             
-            if return_full_fields:
-                memory = {
-                    "id": results.get("ids", [[]])[0][i],
-                    "content": doc,
-                    "relevance": round(relevance, 3),
-                    **metadata
-                }
-            else:
-                memory = {
-                    "id": results.get("ids", [[]])[0][i],
-                    "type": metadata.get("type"),
-                    "title": metadata.get("title"),
-                    "content": doc,
-                    "relevance": round(relevance, 3)
-                }
+        Returns:
+            全局 top-k 检索结果
+        """
+        collections = [self.get_collection(name) for name in shards]
+        
+        def _query(collection: Any) -> Dict[str, Any]:
+            return collection.query(
+                query_embeddings=[query_embedding],
+                n_results=n_results,
+                where=where_clause,
+                include=["documents", "metadatas", "distances"]
+            )
+        
+        if len(collections) == 1:
+            results = [_query(collections[0])]
+        else:
+            # 多分片并行检索，再按距离合并取全局 top-k
+            with ThreadPoolExecutor(max_workers=min(SHARD_QUERY_MAX_WORKERS, len(collections))) as pool:
+                results = list(pool.map(_query, collections))
+        return _merge_shard_results(results, collections, n_results)
+    
+    def _load_embedding_mirror(self, character_id: str) -> Tuple[List[str], np.ndarray, Optional[np.ndarray], np.ndarray, List[str], List[Dict[str, Any]]]:
+        """
+        拉取角色全部记忆向量到内存；本实例新增记忆时增量追加，更新/删除时失效，
+        其他写入方的改动在定期比对条数或镜像过期后重新拉取
+        """
+        mirror = self._cached_mirror(character_id)
+        if mirror is not None:
+            return mirror
+        with self._mirror_lock:
+            mirror = self._cached_embeddings.get(character_id)
+            if mirror is None:
+                mirror = self._fetch_embedding_mirror(character_id)
+                now = time.monotonic()
+                self._cached_embeddings[character_id] = mirror
+                self._mirror_state[character_id] = (now, now)
+                while len(self._cached_embeddings) > MIRROR_CACHE_SIZE:
+                    self._drop_mirror(next(iter(self._cached_embeddings)))
+        return mirror
+    
+    def _cached_mirror(self, character_id: str) -> Optional[Tuple[List[str], np.ndarray, Optional[np.ndarray], np.ndarray, List[str], List[Dict[str, Any]]]]:
+        """
+        获取仍然有效的已加载镜像：超过 MIRROR_MAX_AGE 或集合条数与镜像不一致时丢弃并返回None
+        """
+        mirror = self._cached_embeddings.get(character_id)
+        if mirror is None:
+            return None
+        loaded_at, checked_at = self._mirror_state.get(character_id, (0.0, 0.0))
+        now = time.monotonic()
+        stale = now - loaded_at > MIRROR_MAX_AGE
+        if not stale and now - checked_at > MIRROR_CHECK_INTERVAL:
+            stale = self._stored_count(character_id) != len(mirror[0])
+            self._mirror_state[character_id] = (loaded_at, now)
+        with self._mirror_lock:
+            if self._cached_embeddings.get(character_id) is not mirror:
+                return None
+            if stale:
+                self._drop_mirror(character_id)
+                return None
+            self._cached_embeddings.move_to_end(character_id)
+        return mirror
+    
+    def _drop_mirror(self, character_id: str) -> None:
+        """
+        丢弃角色的向量镜像（调用方需持有 _mirror_lock）
+        """
+        self._cached_embeddings.pop(character_id, None)
+        self._mirror_state.pop(character_id, None)
+    
+    def _stored_count(self, character_id: str) -> int:
+        """
+        统计角色全部分片中已存储的记忆条数（集合不存在时计为0）
+        """
+        collections = [self._existing_collection(name) for name in self._shard_names(character_id)]
+        return sum(c.count() for c in collections if c is not None)
+    
+    def _fetch_embedding_mirror(self, character_id: str) -> Tuple[List[str], np.ndarray, Optional[np.ndarray], np.ndarray, List[str], List[Dict[str, Any]]]:
+        """
+        从 Chroma 读取角色全部记忆构建向量镜像
+        
+        开启 quantize 时直接由元数据中的 int8 向量构建镜像（常驻内存为 float32 的 1/4），
+        否则为行归一化的 float32 连续矩阵
+        """
+        def _fetch(include: List[str]) -> Dict[str, List[Any]]:
+            result = {field: [] for field in ["ids", *include]}
+            for name in self._shard_names(character_id):
+                collection = self._existing_collection(name)
+                if collection is None:
+                    continue
+                part = collection.get(include=include)
+                for field, values in result.items():
+                    values.extend(part[field])
+            return result
+        
+        scales = None
+        result = _fetch(["documents", "metadatas"] if self.quantize else ["embeddings", "documents", "metadatas"])
+        ids = result["ids"]
+        if self.quantize and ids and all("embedding_q8" in m for m in result["metadatas"]):
+            matrix, scales = _stack_int8(result["metadatas"])
+            # 镜像中不再保留 base64 向量文本
+            for m in result["metadatas"]:
+                m.pop("embedding_q8", None)
+        elif len(ids):
+            if "embeddings" not in result:
+                # 存在开启量化前写入的记忆，回退到读取 float32 向量
+                result = _fetch(["embeddings", "documents", "metadatas"])
+                ids = result["ids"]
+            matrix = np.ascontiguousarray(result["embeddings"], dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix /= np.where(norms == 0, 1.0, norms)
+        else:
+            matrix = np.empty((0, 0), dtype=np.float32)
+        importance = np.fromiter(
+            (
+                m["importance_score"] if "importance_score" in m
+                else _importance_score(_decode_nested(dict(m)).get("importance"))
+                for m in result["metadatas"]
+            ),
+            dtype=np.float32, count=len(ids)
+        )
+        return ids, matrix, scales, importance, result["documents"], result["metadatas"]
+    
+    def rerank_memories(self, 
+                character_id: str, 
+                query_text: str, 
+                n_results: int = 5) -> List[Dict[str, Any]]:
+        """
+        在本地向量镜像上按 相关度 * (重要性/10) 综合得分重排，返回 top-k
+        
+        Args:
+            character_id: 角色ID
+            query_text: 查询文本
+            n_results: 返回数量
             
-            memories.append(memory)
+        Returns:
+            记忆列表（含 relevance 与综合得分 score）
+        """
+        self.flush(character_id)
+        ids, matrix, scales, importance, docs, metas = self._load_embedding_mirror(character_id)
+        if not ids:
+            return []
         
-        return memories
+        query = np.asarray(self._cached_embed(query_text), dtype=np.float32)
+        query /= (np.linalg.norm(query) or 1.0)
+        relevances = _cosine_similarities(query, matrix, scales)
+        scores = relevances * (importance / 10.0)
+        
+        k = min(n_results, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            {
+                "id": ids[i],
+                "type": metas[i].get("type"),
+                "title": metas[i].get("title"),
+                "content": docs[i],
+                "relevance": round(float(relevances[i]), 3),
+                "score": round(float(scores[i]), 3)
+            }
+            for i in top
+        ]
     
     # 7. 新增：异步方法 query_memories_async
     async def query_memories_async(self, 
@@ -293,8 +1632,8 @@ class ChromaMemoryStore:
         """
         异步查询记忆（完整支持所有字段反序列化和字段映射）
         """
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, self._sync_query_memories, character_id, query_text, n_results, memory_type, min_importance, return_full_fields)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._sync_query_memories, character_id, query_text, n_results, memory_type, min_importance, return_full_fields)
 
     # 8. 修改：同步方法 query_memories 现在调用内部同步方法
     def query_memories(self, 
@@ -318,6 +1657,22 @@ class ChromaMemoryStore:
         """
         return self._sync_add_memories(character_id, memories_data)
     
+    def add_memories_multi(self, batches: Dict[str, List[Dict[str, Any]]]) -> Dict[str, List[str]]:
+        """
+        并发为多个角色批量添加记忆（各角色集合相互独立，瓶颈在 Embedding 网络请求）
+        
+        Args:
+            batches: 角色ID到记忆数据列表的映射
+            
+        Returns:
+            角色ID到新增记忆ID列表的映射
+        """
+        if not batches:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(MULTI_ADD_MAX_WORKERS, len(batches))) as pool:
+            futures = {cid: pool.submit(self._sync_add_memories, cid, memories) for cid, memories in batches.items()}
+            return {cid: future.result() for cid, future in futures.items()}
+    
     # 10. 修改：同步方法 add_memory 现在调用内部同步方法
     def add_memory(self, 
                 character_id: str, 
@@ -338,36 +1693,35 @@ class ChromaMemoryStore:
         Returns:
             记忆数据，如果不存在则返回None
         """
-        collection_name = self.get_character_collection_name(character_id)
+        return (self.get_memories_by_ids(character_id, [memory_id]) or [None])[0]
+    
+    def get_memories_by_ids(self, character_id: str, memory_ids: List[str]) -> List[Dict[str, Any]]:
+        """
+        通过ID批量获取记忆（一次 collection.get）
         
-        try:
-            collection = self.get_collection(collection_name)
-            result = collection.get(ids=[memory_id])
-            
-            if not result["ids"]:
-                return None
-            
-            metadata = result["metadatas"][0]
-            
-            try:
-                if isinstance(metadata.get("time"), str):
-                    metadata["time"] = json.loads(metadata["time"])
-            except json.JSONDecodeError:
-                pass
+        Args:
+            character_id: 角色ID
+            memory_ids: 记忆ID列表
             
+        Returns:
+            存在的记忆数据列表，集合不存在时返回空列表
+        """
+        if not memory_ids:
+            return []
+        self.flush(character_id)
+        
+        memories = []
+        for name in self._shard_names(character_id):
             try:
-                if isinstance(metadata.get("emotion"), str):
-                    metadata["emotion"] = json.loads(metadata["emotion"])
-            except json.JSONDecodeError:
-                pass
-            
-            return {
-                "id": result["ids"][0],
-                "content": result["documents"][0],
-                **metadata
-            }
-        except Exception:
-            return None
+                collection = self.get_collection(name, require_embedding=False)
+                result = collection.get(ids=memory_ids, include=["documents", "metadatas"])
+            except Exception:
+                continue
+            memories.extend(
+                {"id": i, "content": d, **_format_hit(i, d, m, 0.0, character_id, True).metadata}
+                for i, d, m in zip(result["ids"], result["documents"], result["metadatas"])
+            )
+        return memories
     
     def update_memory(self, 
                      character_id: str, 
@@ -384,31 +1738,32 @@ class ChromaMemoryStore:
         Returns:
             是否更新成功
         """
-        collection_name = self.get_character_collection_name(character_id)
+        self.flush(character_id)
+        shards = self._shard_names(character_id)
         
         try:
-            collection = self.get_collection(collection_name)
-            
-            memory_text = f"{memory_data.get('title', '')}: {memory_data.get('content', '')}"
-            
-            metadata = {}
-            metadata["character_id"] = character_id
-            metadata["memory_type"] = memory_data.get("type", "general")
-            
-            time_data = memory_data.get("time", "")
-            metadata["time"] = json.dumps(time_data, ensure_ascii=False) if isinstance(time_data, dict) else time_data
+            collection = self.get_collection(shards[0])
+            if len(shards) > 1:
+                # 多分片时定位记忆所在分片
+                collection = next(
+                    (c for c in map(self.get_collection, shards) if c.get(ids=[memory_id], include=[])["ids"]),
+                    collection
+                )
             
-            emotion_data = memory_data.get("emotion", "neutral")
-            metadata["emotion"] = json.dumps(emotion_data, ensure_ascii=False) if isinstance(emotion_data, dict) else emotion_data
-            
-            metadata["importance"] = memory_data.get("importance", 5)
-            metadata["title"] = memory_data.get("title", "")
+            memory_text, metadata = _build_record(memory_data)
+            # 重新计算向量（Chroma 更新时合并元数据，开启量化时需同时覆盖旧的 int8 向量）
+            embedding = self._embed_documents([memory_text])[0]
+            if self.quantize:
+                payload, scale = _quantize_int8(embedding)
+                metadata = {**metadata, "embedding_q8": payload, "embedding_scale": scale}
             
             collection.update(
                 ids=[memory_id],
                 documents=[memory_text],
+                embeddings=[embedding],
                 metadatas=[metadata]
             )
+            self._invalidate_query_cache(character_id)
             
             return True
         except Exception:
@@ -425,11 +1780,48 @@ class ChromaMemoryStore:
         Returns:
             是否删除成功
         """
-        collection_name = self.get_character_collection_name(character_id)
+        return self.delete_memories(character_id, [memory_id])
+    
+    def delete_memories(self, character_id: str, memory_ids: List[str]) -> bool:
+        """
+        通过ID批量删除记忆（每个分片一次 collection.delete）
+        
+        Args:
+            character_id: 角色ID
+            memory_ids: 记忆ID列表
+            
+        Returns:
+            是否删除成功
+        """
+        if not memory_ids:
+            return True
+        return self._delete(character_id, ids=memory_ids)
+    
+    def delete_memories_where(self, character_id: str, where: Dict[str, Any]) -> bool:
+        """
+        按元数据条件批量删除记忆，无需先查询ID
+        
+        Args:
+            character_id: 角色ID
+            where: Chroma where 条件，字段为存储的元数据（type、title、importance_score 等）
+            
+        Returns:
+            是否删除成功
+        """
+        return self._delete(character_id, where=where)
+    
+    def _delete(self, character_id: str, **kwargs: Any) -> bool:
+        """
+        在角色全部分片上执行 collection.delete，并失效缓存与分片计数
+        """
+        self.flush(character_id)
+        shards = self._shard_names(character_id)
         
         try:
-            collection = self.get_collection(collection_name)
-            collection.delete(ids=[memory_id])
+            for name in shards:
+                self.get_collection(name, require_embedding=False).delete(**kwargs)
+                self._shard_counts.pop(name, None)
+            self._invalidate_query_cache(character_id)
             return True
         except Exception:
             return False
@@ -444,15 +1836,241 @@ class ChromaMemoryStore:
         Returns:
             是否删除成功
         """
-        collection_name = self.get_character_collection_name(character_id)
+        self.flush(character_id)
+        shards = self._shard_names(character_id)
         
         try:
-            self.get_collection(collection_name)
-            self.client.delete_collection(collection_name)
+            self.get_collection(shards[0], require_embedding=False)
+            for name in shards:
+                self.client.delete_collection(name)
+                with self._collections_lock:
+                    self._collections.pop(name, None)
+                self._shard_counts.pop(name, None)
+            with self._shards_lock:
+                self._shards.pop(character_id, None)
+            self._invalidate_query_cache(character_id)
             return True
         except Exception:
             return False
 
+class AsyncChromaMemoryStore:
+    """
+    基于 Chroma 原生异步客户端（AsyncHttpClient）的记忆存储
+    
+    需要独立运行的 Chroma 服务；所有读写直接 await 网络 I/O，不占用线程池。
+    集合命名与分片、元数据结构、默认向量模型及查询过滤方式（超量召回后本地过滤）与 ChromaMemoryStore 一致，
+    两者可读写同一服务上的集合。仅支持 OpenAI 向量后端，不提供 int8 量化、本地向量镜像与查询缓存
+    """
+    
+    def __init__(self, client: Any, openai_api_key: Optional[str] = None,
+                 embedding_model: Optional[str] = None,
+                 hnsw_config: Optional[Dict[str, Any]] = None):
+        """
+        初始化（请使用 create() 构建，异步客户端需要 await 创建）
+        
+        Args:
+            client: chromadb.AsyncHttpClient 实例
+            openai_api_key: OpenAI API密钥，如果为None则从环境变量获取
+            embedding_model: 向量模型名称，默认与 ChromaMemoryStore 的 openai 后端一致
+            hnsw_config: 覆盖默认 HNSW 参数，仅对新建集合生效
+        """
+        self.client = client
+        self.embedding_model = embedding_model or DEFAULT_EMBEDDING_MODELS["openai"]
+        self.hnsw_config = {**DEFAULT_HNSW_CONFIG, **(hnsw_config or {})}
+        # 复用进程内共享的 HTTP 连接池；重试统一由 _openai_retry 负责，关闭 SDK 内置重试
+        self.openai = AsyncOpenAI(
+            api_key=openai_api_key or os.environ.get("OPENAI_API_KEY"),
+            http_client=_shared_http_client(),
+            max_retries=0
+        )
+        self._collections: Dict[str, Any] = {}
+        # 分片信息：character_id -> 分片集合名称列表；集合名称 -> 已写入条数
+        self._shards: Dict[str, List[str]] = {}
+        self._shard_counts: Dict[str, int] = {}
+        self._shards_lock = asyncio.Lock()
+    
+    @classmethod
+    async def create(cls, host: str = "localhost", port: int = 8000, **kwargs: Any) -> "AsyncChromaMemoryStore":
+        """
+        创建异步存储实例（设置了 CHROMA_HTTP_URL 时优先使用其中的地址）
+        
+        Args:
+            host: Chroma 服务地址
+            port: Chroma 服务端口
+            **kwargs: 透传给构造函数的参数
+            
+        Returns:
+            AsyncChromaMemoryStore 实例
+        """
+        ssl = False
+        http_url = os.environ.get("CHROMA_HTTP_URL")
+        if http_url:
+            parsed = urlparse(http_url)
+            host = parsed.hostname or host
+            port = parsed.port or port
+            ssl = parsed.scheme == "https"
+        client = await chromadb.AsyncHttpClient(
+            host=host, port=port, ssl=ssl,
+            settings=Settings(anonymized_telemetry=False)
+        )
+        return cls(client, **kwargs)
+    
+    async def _get_or_create(self, name: str) -> Any:
+        """
+        获取（不存在则创建）记忆集合并缓存句柄；向量由本类计算，集合不绑定向量函数
+        """
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = await self.client.get_or_create_collection(
+                name=name, embedding_function=None, metadata=self.hnsw_config
+            )
+            self._collections[name] = collection
+        return collection
+    
+    async def _existing_collection(self, name: str) -> Optional[Any]:
+        """
+        获取已存在的集合（读路径使用，不会创建集合），不存在时返回None
+        """
+        collection = self._collections.get(name)
+        if collection is None:
+            try:
+                collection = await self.client.get_collection(name=name, embedding_function=None)
+            except (InvalidCollectionException, ValueError):
+                return None
+            self._collections[name] = collection
+        return collection
+    
+    async def _shard_names(self, character_id: str) -> List[str]:
+        """
+        获取角色的全部分片集合名称（命名规则与 ChromaMemoryStore 相同）
+        """
+        shards = self._shards.get(character_id)
+        if shards is None:
+            base = _collection_name(character_id)
+            shards = [base]
+            while await self._existing_collection(f"{base}_{len(shards)}") is not None:
+                shards.append(f"{base}_{len(shards)}")
+            self._shards[character_id] = shards
+        return list(shards)
+    
+    async def _active_shard(self, character_id: str, incoming: int) -> Any:
+        """
+        获取本次写入的目标分片，写入后超过 SHARD_SIZE 时新建下一个分片
+        """
+        async with self._shards_lock:
+            await self._shard_names(character_id)
+            shards = self._shards[character_id]
+            name = shards[-1]
+            collection = await self._get_or_create(name)
+            count = self._shard_counts.get(name)
+            if count is None:
+                count = await collection.count()
+            if count and count + incoming > SHARD_SIZE:
+                name = f"{shards[0]}_{len(shards)}"
+                shards.append(name)
+                collection = await self._get_or_create(name)
+                count = 0
+            self._shard_counts[name] = count + incoming
+        return collection
+    
+    async def _query_shards(self, shards: List[str], query_embedding: List[float], n_results: int,
+                            where_clause: Optional[Dict[str, Any]]) -> List[tuple]:
+        """
+        在全部分片上并发检索，返回按余弦距离升序的 (距离, ID, 文档, 元数据) 列表
+        """
+        collections = [c for c in await asyncio.gather(*map(self._existing_collection, shards)) if c is not None]
+        results = await asyncio.gather(*(
+            c.query(
+                query_embeddings=[query_embedding],
+                n_results=n_results,
+                where=where_clause,
+                include=["documents", "metadatas", "distances"]
+            )
+            for c in collections
+        ))
+        return _merge_shard_results(list(results), collections, n_results)
+    
+    @_openai_retry
+    async def _create_embeddings(self, **kwargs: Any) -> Any:
+        """调用 embeddings.create，瞬时错误按与 OpenAIClient 相同的策略退避重试"""
+        return await self.openai.embeddings.create(**kwargs)
+    
+    async def _embed(self, texts: List[str]) -> List[List[float]]:
+        """
+        异步批量计算向量（按 EMBEDDING_CHUNK_SIZE 分块并发请求）
+        """
+        chunks = [texts[i:i + EMBEDDING_CHUNK_SIZE] for i in range(0, len(texts), EMBEDDING_CHUNK_SIZE)]
+        responses = await asyncio.gather(*(
+            self._create_embeddings(model=self.embedding_model, input=chunk) for chunk in chunks
+        ))
+        return [item.embedding for response in responses for item in response.data]
+    
+    async def add_memory_async(self, character_id: str, memory_data: Dict[str, Any]) -> str:
+        """
+        异步添加单个记忆
+        """
+        return (await self.add_memories_async(character_id, [memory_data]))[0]
+    
+    async def add_memories_async(self, character_id: str, memories_data: List[Dict[str, Any]]) -> List[str]:
+        """
+        异步批量添加记忆
+        """
+        if not memories_data:
+            return []
+        memory_ids = _new_ids(len(memories_data))
+        records = [_build_record(m) for m in memories_data]
+        documents = [text for text, _ in records]
+        metadatas = [metadata for _, metadata in records]
+        collection, embeddings = await asyncio.gather(
+            self._active_shard(character_id, len(documents)), self._embed(documents)
+        )
+        for i in range(0, len(memory_ids), MAX_ADD_BATCH):
+            await collection.add(
+                ids=memory_ids[i:i + MAX_ADD_BATCH],
+                documents=documents[i:i + MAX_ADD_BATCH],
+                embeddings=embeddings[i:i + MAX_ADD_BATCH],
+                metadatas=metadatas[i:i + MAX_ADD_BATCH]
+            )
+        return memory_ids
+    
+    async def query_memories_async(self, 
+                character_id: str, 
+                query_text: str, 
+                n_results: int = 5,
+                memory_type: Optional[str] = None,
+                min_importance: Optional[int] = None,
+                return_full_fields: bool = False) -> List[Dict[str, Any]]:
+        """
+        异步查询记忆（返回格式与 ChromaMemoryStore.query_memories 一致）
+        """
+        shards = await self._shard_names(character_id)
+        if await self._existing_collection(shards[0]) is None:
+            return []
+        query_embedding = (await self._embed([query_text]))[0]
+        
+        where_clause = _mk_where(memory_type, min_importance)
+        if where_clause is None:
+            hits = await self._query_shards(shards, query_embedding, n_results, None)
+        else:
+            # 与 ChromaMemoryStore 相同：超量召回后本地过滤，不足 k 条时回退到 Chroma 原生过滤
+            fetch = n_results * FILTER_OVERFETCH
+            hits = await self._query_shards(shards, query_embedding, fetch, None)
+            exhausted = len(hits) < fetch
+            hits = _filter_hits(hits, memory_type, min_importance, n_results)
+            if len(hits) < n_results and not exhausted:
+                hits = await self._query_shards(shards, query_embedding, n_results, where_clause)
+        
+        if not hits:
+            return []
+        distances, ids, docs, metas = zip(*hits)
+        dists = np.asarray(distances, dtype=np.float32)
+        relevances = np.round(1.0 - dists, 3).tolist()
+        return [
+            _format_hit(i, d, m, r, character_id, return_full_fields).to_dict()
+            for i, d, m, r in zip(ids, docs, metas, relevances)
+        ]
+
+
 if __name__ == "__main__":
     api_key = os.environ.get("OPENAI_API_KEY")
     if not api_key:
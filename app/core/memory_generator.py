@@ -1,14 +1,76 @@
 import openai
 import json
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any
 from app.models.character import Character
 from app.crud.crud_memory import add_memory
 
+# 优先使用 orjson 解析，未安装时回退到标准库
+try:
+    from orjson import loads as _loads
+except ImportError:  # pragma: no cover
+    _loads = json.loads
+
+# 流式生成时并发写入记忆的线程数
+MEMORY_WRITE_WORKERS = 4
+
+
+@functools.lru_cache(maxsize=8)
+def _get_openai_client(api_key: str) -> openai.OpenAI:
+    """获取（并缓存）按 api_key 共享的 OpenAI 客户端，多个生成器实例复用同一连接池"""
+    return openai.OpenAI(api_key=api_key)
+
+
+class _MemoryStreamParser:
+    """
+    流式响应的增量 JSON 扫描器：线性扫描括号深度（跳过字符串内的括号），
+    每当 {"memories": [ {...}, ... ]} 中的一条记忆对象闭合时立即解析返回
+    """
+    
+    def __init__(self):
+        self._buffer: List[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+    
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        """
+        输入一段增量文本，返回其中新闭合的记忆对象
+        """
+        memories = []
+        for ch in text:
+            if self._depth >= 2:
+                self._buffer.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+                if self._depth == 2:
+                    self._buffer = ["{"]
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 1:
+                    raw = "".join(self._buffer)
+                    try:
+                        memories.append(_loads(raw))
+                    except ValueError as e:
+                        print(f"跳过无法解析的记忆对象: {e} | {raw[:200]}")
+                    self._buffer = []
+        return memories
+
 class MemoryGenerator:
     """角色记忆生成器"""
     
     def __init__(self, api_key: str):
-        self.client = openai.OpenAI(api_key=api_key)
+        self.client = _get_openai_client(api_key)
         
         # 预定义事件类型库
         self.event_types = [
@@ -59,48 +121,65 @@ class MemoryGenerator:
 }}
 """
         
-        try:
-            response = self.client.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=[
-                    {"role": "system", "content": "你是一个专业的角色背景设计师，擅长创建真实、具体的人生经历。"},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.8,
-                max_tokens=2000
-            )
-            
-            content = response.choices[0].message.content
-            
-            # 提取JSON部分
-            import re
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                json_str = json_match.group()
-                memories_data = json.loads(json_str)
-                
-                # 存储记忆到ChromaDB
-                memory_ids = []
-                for memory in memories_data.get("memories", []):
-                    memory_id = add_memory(
-                        character_id=character.id,
-                        memory_text=memory["text"],
-                        event_type=memory.get("event_type", "未分类"),
-                        metadata={
-                            "time_period": memory.get("time_period", "未知"),
-                            "generated": True
-                        }
-                    )
-                    memory_ids.append(memory_id)
-                
-                return memory_ids
-            else:
-                raise ValueError("无法从响应中提取有效的JSON")
-                
-        except Exception as e:
-            print(f"生成记忆时出错: {e}")
-            # 生成默认记忆
-            return self._generate_default_memories(character)
+        # 流式接收：每条记忆对象闭合后立即提交写入ChromaDB，写入与后续生成并行
+        parser = _MemoryStreamParser()
+        futures = []
+        error = None
+        with ThreadPoolExecutor(max_workers=MEMORY_WRITE_WORKERS) as pool:
+            try:
+                stream = self.client.chat.completions.create(
+                    model="gpt-4.1-mini",
+                    messages=[
+                        {"role": "system", "content": "你是一个专业的角色背景设计师，擅长创建真实、具体的人生经历。"},
+                        {"role": "user", "content": prompt}
+                    ],
+                    temperature=0.8,
+                    max_tokens=2000,
+                    # JSON 模式保证输出为合法 JSON，无需再从回复中抽取
+                    response_format={"type": "json_object"},
+                    stream=True
+                )
+                for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if not delta:
+                        continue
+                    for memory in parser.feed(delta):
+                        if "text" in memory:
+                            futures.append(pool.submit(self._store_memory, character, memory))
+                        else:
+                            print(f"跳过缺少 text 字段的记忆对象: {str(memory)[:200]}")
+            except Exception as e:
+                error = e
+        
+        memory_ids = []
+        for future in futures:
+            try:
+                memory_ids.append(future.result())
+            except Exception as e:
+                error = error or e
+        
+        if error is not None:
+            print(f"生成记忆时出错: {error}（已写入 {len(memory_ids)} 条）")
+        elif not memory_ids:
+            print("生成记忆时出错: 无法从响应中提取有效的JSON")
+        # 已有记忆写入时保留这部分结果，只有一条都没写入才生成默认记忆，避免两者混在一起
+        if memory_ids:
+            return memory_ids
+        return self._generate_default_memories(character)
+    
+    def _store_memory(self, character: Character, memory: Dict[str, Any]) -> str:
+        """存储一条生成的记忆到ChromaDB"""
+        return add_memory(
+            character_id=character.id,
+            memory_text=memory["text"],
+            event_type=memory.get("event_type", "未分类"),
+            metadata={
+                "time_period": memory.get("time_period", "未知"),
+                "generated": True
+            }
+        )
     
     def _build_character_context(self, character: Character) -> str:
         """构建角色上下文信息"""
@@ -9,13 +9,23 @@
 import asyncio
 import json
 import time
-from typing import Dict, List, Any, Optional, AsyncGenerator
+from typing import Dict, List, Any, Optional, AsyncGenerator, AsyncIterator, Awaitable, Callable
 
+from cachetools import TTLCache
+
+from app.core.cache.semantic_cache import SemanticLRU
 from app.core.llm.openai_client import CharacterLLM
 # --- 修改导入 ---
 from app.core.graph.graph_store import GraphStore # 导入新版 GraphStore
 # ---
 
+def _embedding_of(task: asyncio.Future) -> Optional[List[float]]:
+    """取出已完成的查询向量任务的结果，失败或被取消时返回None"""
+    if task.cancelled() or task.exception() is not None:
+        return None
+    return task.result()[0]
+
+
 class ResponseFlow:
     """
     三阶段响应流程类
@@ -25,10 +35,14 @@ class ResponseFlow:
     def __init__(self, 
                 character_llm: Optional[CharacterLLM] = None,
                 # --- 修改参数 ---
-                graph_store: Optional[GraphStore] = None): # 确保类型注解是新版 GraphStore
+                graph_store: Optional[GraphStore] = None, # 确保类型注解是新版 GraphStore
+                semantic_cache: Optional[SemanticLRU] = None):
         self.character_llm = character_llm or CharacterLLM()
         self.graph_store = graph_store or GraphStore() # 使用新版 GraphStore
         # ---
+        # 意图判断与直接回复的语义缓存；查询向量按文本缓存（存放任务，同一轮并发调用只请求一次）
+        self.semantic_cache = semantic_cache or SemanticLRU()
+        self._query_embeddings: TTLCache = TTLCache(maxsize=256, ttl=600)
         self.memory_type_rules = {
             "education": "需体现学习方式与思维模式的关联（如记忆中“如何学习”影响“现在如何思考”）",
             "work": "需包含职业技能与价值观的互动（如记忆中“解决问题的技能”反映“职业价值观”）",
@@ -49,39 +63,54 @@ class ResponseFlow:
         """主流程：仅保留核心逻辑，无硬编码提取步骤"""
         start_time = time.time()
         # 1. 判断是否需要记忆（基于LLM自主分析，不做硬编码规则）
-        # 2. 修改：await 调用异步 _needs_memory
-        needs_memory = await self._needs_memory(character_data, user_input)
-        
-        if not needs_memory:
-            # 3. 修改：await 调用异步 _generate_direct_response
-            direct_resp = await self._generate_direct_response(character_data, user_input, conversation_history)
-            yield {
-                "type": "direct", 
-                "content": direct_resp, 
-                "timestamp": round(time.time() - start_time, 2)
-            }
-            return
-        
-        # 2. 三阶段流程（记忆检索返回完整格式，不做提前提取）
-        # 4. 修改：创建任务以并行执行 immediate response 和 memory retrieval
-        immediate_task = asyncio.create_task(self._generate_immediate_response(character_data, user_input, conversation_history))
+        # 2. 修改：记忆检索与意图判断同时启动（投机预取），需要记忆时检索不再排在判断之后
+        needs_task = asyncio.create_task(self._needs_memory(character_data, user_input))
         # --- 修改：调用图谱检索 ---
         # memory_task = asyncio.create_task(self._retrieve_relevant_memories(character_id, user_input))
         memory_task = asyncio.create_task(self._retrieve_relevant_memories_from_graph(character_id, user_input))
         # ---
+        # 流式输出期间出错或调用方断开（GeneratorExit）时，取消仍在后台运行的任务
+        try:
+            needs_memory = await needs_task
+            
+            if not needs_memory:
+                memory_task.cancel()
+                # 3. 修改：await 调用异步 _generate_direct_response
+                direct_resp = await self._generate_direct_response(character_data, user_input, conversation_history)
+                yield {
+                    "type": "direct", 
+                    "content": direct_resp, 
+                    "timestamp": round(time.time() - start_time, 2)
+                }
+                return
+            
+            # 2. 三阶段流程（记忆检索返回完整格式，不做提前提取）
+            # 4. 修改：记忆检索已在后台进行，与下意识响应的流式生成并行执行
+            # 5. 修改：流式生成下意识响应，每个片段到达即产出 immediate_delta，首字延迟降至首 token 延迟
+            immediate_parts = []
+            async for delta in self._stream_immediate_response(character_data, user_input, conversation_history):
+                immediate_parts.append(delta)
+                yield {
+                    "type": "immediate_delta",
+                    "content": delta,
+                    "timestamp": round(time.time() - start_time, 2)
+                }
+            immediate_resp = "".join(immediate_parts).strip()
+            # 返回完整的下意识响应（供不处理增量片段的客户端使用）
+            yield {
+                "type": "immediate", 
+                "content": immediate_resp, 
+                "timestamp": round(time.time() - start_time, 2)
+            }
+            
+            # 处理记忆结果
+            # 6. 修改：await memory retrieval task
+            memories = await memory_task
+        finally:
+            for task in (needs_task, memory_task):
+                if not task.done():
+                    task.cancel()
         
-        # 5. 修改：await immediate response task
-        immediate_resp = await immediate_task
-        # 返回下意识响应
-        yield {
-            "type": "immediate", 
-            "content": immediate_resp, 
-            "timestamp": round(time.time() - start_time, 2)
-        }
-        
-        # 处理记忆结果
-        # 6. 修改：await memory retrieval task
-        memories = await memory_task
         if memories:
             # 7. 修改：await 调用异步 _generate_supplementary_response
             supplementary_resp = await self._generate_supplementary_response(
@@ -213,9 +242,55 @@ class ResponseFlow:
 """
         user_prompt = f"用户问题：{user_input}\n判断结果（仅YES/NO）："
         
-        # 13. 修改：await 调用 LLM 异步方法
-        result = await self.character_llm.client.generate_response(system_prompt, user_prompt)
-        return result.strip().upper() == "YES"
+        async def _classify() -> bool:
+            # 13. 修改：await 调用 LLM 异步方法
+            result = await self.character_llm.client.generate_response(system_prompt, user_prompt)
+            return result.strip().upper() == "YES"
+        
+        # 相同人设下语义相近的问题直接复用判断结果
+        return await self._semantic_cached(("needs_memory", system_prompt), user_input, _classify)
+    
+    def _embed_query(self, text: str) -> Awaitable[List[List[float]]]:
+        """获取查询文本的向量（按文本缓存；shield 保证某个调用方被取消时不影响其他调用方）"""
+        task = self._query_embeddings.get(text)
+        if task is None:
+            task = asyncio.ensure_future(self.character_llm.client.create_embeddings([text]))
+            task.add_done_callback(
+                lambda t: (t.cancelled() or t.exception() is not None) and self._query_embeddings.pop(text, None)
+            )
+            self._query_embeddings[text] = task
+        return asyncio.shield(task)
+    
+    async def _semantic_cached(self, namespace: Any, user_input: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        先精确匹配语义缓存；未命中时查询向量与 compute 同时启动，
+        向量先返回且近似命中则取消 compute，否则向量只用于写入缓存，不阻塞 compute
+        """
+        cached = self.semantic_cache.get_exact(namespace, user_input)
+        if cached is not None:
+            return cached
+        embed_task = asyncio.ensure_future(self._embed_query(user_input))
+        compute_task = asyncio.ensure_future(compute())
+        try:
+            await asyncio.wait({embed_task, compute_task}, return_when=asyncio.FIRST_COMPLETED)
+            if not compute_task.done():
+                embedding = _embedding_of(embed_task)
+                cached = self.semantic_cache.lookup(namespace, embedding) if embedding is not None else None
+                if cached is not None:
+                    compute_task.cancel()
+                    return cached
+            value = await compute_task
+        except BaseException:
+            compute_task.cancel()
+            embed_task.cancel()
+            raise
+        
+        def _store(task: asyncio.Future) -> None:
+            self.semantic_cache.insert(namespace, user_input, _embedding_of(task), value)
+        
+        self.semantic_cache.insert(namespace, user_input, None, value)
+        embed_task.add_done_callback(_store)
+        return value
     
     # --- 修改：_retrieve_relevant_memories_from_graph 方法 ---
     async def _retrieve_relevant_memories_from_graph(self, character_id: str, query_text: str, n_results: int = 3) -> List[Dict[str, Any]]:
@@ -235,7 +310,7 @@ class ResponseFlow:
         # 假设 self.character_llm.client 有 create_embeddings 方法
         try:
             # 将查询文本和所有记忆内容合并，用于嵌入
-            query_embedding = await self.character_llm.client.create_embeddings([query_text])
+            query_embedding = await self._embed_query(query_text)
             memory_contents = [mem.get('content', '') for mem in all_raw_memories]
             memory_embeddings = await self.character_llm.client.create_embeddings(memory_contents)
         except Exception as e:
@@ -323,20 +398,29 @@ class ResponseFlow:
         history_str = "\n".join([f"{'用户' if t['role']=='user' else '你'}: {t['content']}" for t in (conversation_history or [])])
         user_prompt = f"{history_str}\n用户：{user_input}\n你的回答："
         
-        # 18. 修改：await 调用 LLM 异步方法
-        return await self.character_llm.client.generate_response(simplified_system_prompt, user_prompt)
+        async def _respond() -> str:
+            # 18. 修改：await 调用 LLM 异步方法
+            return await self.character_llm.client.generate_response(simplified_system_prompt, user_prompt)
+        
+        # 回复依赖对话历史，仅在无历史时使用语义缓存
+        if conversation_history:
+            return await _respond()
+        return await self._semantic_cached(("direct", simplified_system_prompt), user_input, _respond)
     
-    # 19. 修改：_generate_immediate_response 方法改为 async
-    async def _generate_immediate_response(self, character_data: Dict[str, Any], user_input: str, conversation_history: List[Dict[str, str]] = None) -> str:
+    async def _stream_immediate_response(self, character_data: Dict[str, Any], user_input: str, conversation_history: List[Dict[str, str]] = None) -> AsyncIterator[str]:
+        """流式生成下意识响应，按到达顺序产出文本片段"""
+        system_prompt, user_prompt = self._build_immediate_prompts(character_data, user_input, conversation_history)
+        async for delta in self.character_llm.client.stream_response(system_prompt, user_prompt):
+            yield delta
+    
+    def _build_immediate_prompts(self, character_data: Dict[str, Any], user_input: str, conversation_history: List[Dict[str, str]] = None) -> tuple:
         # 20. 修改：使用更简化的 Prompt
         simplified_system_prompt = f"""
 你是{character_data.get('name')}，请非常快速地回复（1-2句，50字以内），符合语言风格：{character_data.get('language_style')}，不涉及具体记忆细节。
 """
         history_str = "\n".join([f"{'用户' if t['role']=='user' else '你'}: {t['content']}" for t in (conversation_history[-2:] if conversation_history else [])])
         user_prompt = f"{history_str}\n用户：{user_input}\n你的简短回复："
-        
-        # 21. 修改：await 调用 LLM 异步方法
-        return await self.character_llm.client.generate_response(simplified_system_prompt, user_prompt)
+        return simplified_system_prompt, user_prompt
     
     # 22. 修改：_generate_no_memory_response 方法改为 async
     async def _generate_no_memory_response(self, character_data: Dict[str, Any], user_input: str, immediate_response: str) -> str:
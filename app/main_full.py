@@ -238,7 +238,7 @@ async def system_status():
             "vector_db": "ChromaDB（支持完整记忆格式）",
             "graph_db": "GraphStore (JSON-based, supports relationship graph)",
             "character_count": len(characters),
-            "response_types": ["direct", "immediate", "supplementary", "no_memory"],
+            "response_types": ["direct", "immediate_delta", "immediate", "supplementary", "no_memory"],
             "features": ["实时响应流", "完整记忆格式", "多响应类型", "直接日志输出", "人物关系图谱"]
         }
     }
@@ -420,6 +420,9 @@ async def chat_with_character(request: ChatRequest):
 
                 yield f" {response_json}\n\n"
 
+                # 增量片段只推送不记录，完整内容随后的 immediate 事件记录
+                if flow_resp["type"] == "immediate_delta":
+                    continue
                 log_chat_response(
                     flow_resp['type'],
                     request.character_id,